@@ -763,9 +763,10 @@ class Analyzer():
         # IMPORTANT: Here it is crucial to have batches of the size used during training in the forward pass
         # if using only a single example, some concepts might not be present but we still enforce the same number of
         # clusters
-        node_table = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_color", "label",
-                                  "activations", "permanent_label"])
-        edge_table = wandb.Table(["graph", "pool_step", "source", "target"])
+        # rows are collected in Python lists and the tables built in one shot at the end: add_data performs
+        # type validation per call, which adds up over thousands of nodes and edges
+        node_rows = []
+        edge_rows = []
         with torch.no_grad():
             # concepts: [batch_size, max_num_nodes_final_layer, embedding_dim_out_final_layer] the node embeddings of the final graph
             pool_activations = [x] + info_pooling_activations
@@ -777,6 +778,16 @@ class Analyzer():
                             + Analyzer.deterministic_node_assignments(model, pool_assignments, info_node_assignments)
 
             for pool_step in range(len(pool_assignments)):
+                # one batched edge extraction for all logged graphs instead of an adj_to_edge_index call per
+                # graph; the cumsum renumbers each graph's unmasked nodes compactly, matching the node rows
+                masks_to_log = masks[pool_step][:samples_per_concept]
+                adjs_to_log = adjs[pool_step][:samples_per_concept] * \
+                    torch.logical_and(masks_to_log[:, :, None], masks_to_log[:, None, :])
+                compact_index = torch.cumsum(masks_to_log, dim=1) - 1
+                edge_graph, edge_source, edge_target = adjs_to_log.nonzero(as_tuple=True)
+                edge_rows += [[g, pool_step, s, t] for g, s, t in
+                              torch.stack((edge_graph, compact_index[edge_graph, edge_source],
+                                           compact_index[edge_graph, edge_target]), dim=1).cpu().tolist()]
                 for graph_i in range(samples_per_concept):
                     # Calculate concept assignment colors
                     # [num_nodes] (with batch dimension and masked nodes removed)
@@ -788,22 +799,22 @@ class Analyzer():
                     node_assignment = node_concepts[pool_step][graph_i][masks[pool_step][graph_i]].detach().cpu()
                     ColorUtils.ensure_min_rgb_feature_colors(torch.max(node_assignment) + 1)
                     # [num_nodes, 3] (intermediate dimensions: num_nodes x num_clusters x 3)
-                    feature_colors = ColorUtils.rgb_feature_colors[node_assignment, :]
-                    for i, i_old in enumerate(masks[pool_step][graph_i].nonzero().squeeze(1)):
-                        node_table.add_data(graph_i, pool_step, i, feature_colors[i, 0].item(),
-                                            feature_colors[i, 1].item(), feature_colors[i, 2].item(),
-                                            ColorUtils.rgb2hex_tensor(concept_colors[i, :]),
-                                            f"Cluster {assignment[i]}",
-                                            ", ".join([f"{m.item():.2f}" for m in
-                                                       pool_activations[pool_step][graph_i, i_old, :].cpu()]),
-                                            "" if pool_step > 0 or ColorUtils.feature_labels is None
-                                            else ColorUtils.feature_labels[node_assignment[i]])
-
-                    edge_index, _, _ = adj_to_edge_index(adjs[pool_step][graph_i:graph_i+1, :, :],
-                                                         masks[pool_step][graph_i:graph_i+1])
-                    for i in range(edge_index.shape[1]):
-                        edge_table.add_data(graph_i, pool_step, edge_index[0, i].item(), edge_index[1, i].item())
+                    feature_colors = ColorUtils.rgb_feature_colors[node_assignment, :].tolist()
+                    concept_hex = ColorUtils.rgb2hex_batch(concept_colors)
+                    assignment_list = assignment.tolist()
+                    node_assignment_list = node_assignment.tolist()
+                    activations_list = pool_activations[pool_step][graph_i].cpu().tolist()
+                    node_rows += [[graph_i, pool_step, i, feature_colors[i][0], feature_colors[i][1],
+                                   feature_colors[i][2], concept_hex[i],
+                                   f"Cluster {assignment_list[i]}",
+                                   ", ".join([f"{m:.2f}" for m in activations_list[i_old]]),
+                                   "" if pool_step > 0 or ColorUtils.feature_labels is None
+                                   else ColorUtils.feature_labels[node_assignment_list[i]]]
+                                  for i, i_old in enumerate(masks[pool_step][graph_i].nonzero().squeeze(1).tolist())]
 
+        node_table = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_color", "label",
+                                  "activations", "permanent_label"], data=node_rows)
+        edge_table = wandb.Table(["graph", "pool_step", "source", "target"], data=edge_rows)
         custom_logger.log(dict(
             # graphs_table=graphs_table
             node_table=node_table,
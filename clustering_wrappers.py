@@ -58,7 +58,12 @@ class ClusterAlgWrapper(abc.ABC, torch.nn.Module):
 
 class KMeansWrapper(ClusterAlgWrapper):
 
-    def __init__(self, trys: int = 1, **kwargs):
+    def __init__(self, trys: int = 1, warm_start: bool = False, **kwargs):
+        """
+        :param warm_start: initialize each fit from the centroids of the previous one instead of random points.
+            Between minibatches the embedding distribution only drifts slowly, so Lloyd's algorithm then
+            converges in far fewer iterations. Mainly useful with local (per-batch) clusters.
+        """
         super().__init__(**kwargs)
         # For backward compatibility:
         kwargs = {k.replace(".", "_"): v for k, v in kwargs.items()}
@@ -70,6 +75,7 @@ class KMeansWrapper(ClusterAlgWrapper):
                 del kwargs[k]
         self.kmeans = KMeans(**kwargs)
         self.trys = trys
+        self.warm_start = warm_start
 
     def fit(self, X: torch.Tensor, train: bool = False) -> None:
         self.fit_predict(X, train)
@@ -78,6 +84,10 @@ class KMeansWrapper(ClusterAlgWrapper):
         return self.kmeans.predict(X)
 
     def fit_predict(self, X: torch.Tensor, train: bool = False) -> torch.Tensor:
+        if self.warm_start and self.kmeans.centroids is not None:
+            # deterministic initialization, so additional random-restart trys would all find the same optimum
+            best, _ = self.kmeans.fit_predict(X, centroids=self.kmeans.centroids)
+            return best
         best, best_cost = self.kmeans.fit_predict(X)
         for _ in range(self.trys - 1):
             res, cost = self.kmeans.fit_predict(X)
@@ -33,7 +33,7 @@ class ColorUtils:
     @classmethod
     def reset(cls):
         cls.rgb_colors = cls._rgb_colors_orig
-        cls._hex_colors_orig = np.array([ColorUtils.rgb2hex_tensor(rgb) for rgb in cls._rgb_colors_orig])
+        cls._hex_colors_orig = ColorUtils.rgb2hex_batch(cls._rgb_colors_orig)
         cls.hex_colors = cls._hex_colors_orig
         cls.rgb_feature_colors = cls.rgb_colors
         cls.hex_feature_colors = cls.hex_colors
@@ -42,7 +42,7 @@ class ColorUtils:
     @classmethod
     def set_feature_colors(cls, rgb_colors: torch.Tensor):
         cls.rgb_feature_colors = rgb_colors
-        cls.hex_feature_colors = np.array([ColorUtils.rgb2hex_tensor(rgb) for rgb in rgb_colors])
+        cls.hex_feature_colors = ColorUtils.rgb2hex_batch(rgb_colors)
 
     @staticmethod
     def rgb2hex(r: int, g: int, b: int):
@@ -53,6 +53,16 @@ class ColorUtils:
         ten = torch.round(ten).to(int)
         return ColorUtils.rgb2hex(ten[0].item(), ten[1].item(), ten[2].item())
 
+    @staticmethod
+    def rgb2hex_batch(colors: torch.Tensor) -> np.ndarray:
+        """
+        Converts a whole [num_colors, 3] tensor to '#rrggbb' strings with one bit-packing kernel, one host
+        transfer and one vectorized format, instead of three .item() syncs plus an f-string per color.
+        """
+        packed = torch.round(colors).to(torch.int64)
+        packed = (packed[:, 0] << 16) | (packed[:, 1] << 8) | packed[:, 2]
+        return np.char.mod("#%06x", packed.cpu().numpy())
+
     @classmethod
     def ensure_min_hex_colors(cls, required_colors: int):
         if cls.hex_colors.shape[0] < required_colors:
@@ -3,11 +3,14 @@ from typing import Optional, Any, Dict, List
 import wandb
 device = None
 cpu_workers: Optional[int] = None
+use_wandb = True
 wandb_project = "MPhil-project"
 wandb_entity = "jonas-juerss"
 
 
 def init(args):
+    global use_wandb
+    use_wandb = args.use_wandb
     if args.use_wandb:
         wandb_args = dict(
             project=wandb_project,
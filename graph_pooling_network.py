@@ -8,6 +8,7 @@ from torch_geometric.data import Data
 import torch
 from torch_geometric.nn import DenseGCNConv
 
+import custom_logger
 from blackbox_backprop import BlackBoxModule
 from poolblocks.poolblock import PoolBlock, MonteCarloBlock
 
@@ -108,6 +109,9 @@ class DifferentiablePoolingNet(BlackBoxModule):
         return final_res, [block_res] + intermediate_res
 
     def log_assignments(self, *args, **kwargs):
+        if not custom_logger.use_wandb:
+            # without wandb the tables would be computed and then silently dropped by log()
+            return
         for block in self.pool_blocks:
             block.log_assignments(*args, **kwargs)
 
@@ -12,6 +12,14 @@ from torch_scatter import scatter
 
 import custom_logger
 
+try:
+    import cudf
+    import cugraph
+    _cugraph_available = True
+except ModuleNotFoundError:
+    cudf = cugraph = None
+    _cugraph_available = False
+
 def mask_to_batch(mask: torch.Tensor):
     """
 
@@ -75,23 +83,23 @@ def sparse_components_scipy(edge_index: torch.Tensor, num_nodes: int, connection
     num_components, component = sp.csgraph.connected_components(adj, connection=connection)
     return num_components, torch.tensor(component, device=custom_logger.device)
 
-def dense_components(adj: torch.Tensor, mask: Optional[torch.Tensor] = None, connection="weak", is_directed: bool = True):
+def components_from_edge_index(edge_index: torch.Tensor, batch: torch.Tensor, num_nodes: int, max_num_nodes: int,
+                               connection="weak", is_directed: bool = True):
     """
 
-    :param adj: [max_num_nodes, max_num_nodes] or [batch_size, max_num_nodes, max_num_nodes]
-    :param mask: None or [max_num_nodes] or [batch_size, max_num_nodes]
+    :param edge_index: [2, num_edges] over compact node indices (masked nodes removed, numbered consecutively)
+    :param batch: [num_nodes] batch element of each (compact) node
+    :param num_nodes: total number of nodes
+    :param max_num_nodes: number of node slots per batch element in the dense output
     :return:
-        max_num_components: maximum number of components in any graph
-        component: [batch_size, max_num_nodes] integers mapping each node to a component. Starting
+        component: [batch_size, max_num_nodes] integers mapping each node to a component, 0 for masked nodes
     """
-    edge_index, batch, num_nodes = adj_to_edge_index(adj, mask)
-    # TODO check if iterating over all samples and therefore having significantly less nodes per search is more efficient despite the overhead of more conversions
     # component: [num_nodes_total]
     num_components, component = sparse_components(edge_index, num_nodes, connection, is_directed)
     # [batch_size] minimum component index for each batch element
     component_starts = scatter(component, batch, reduce="min")
     # [batch_size, max_num_components] (where max_num_components is the maximum number of components in any single batch element)
-    dense_component, mask_new = to_dense_batch(component, batch, max_num_nodes=adj.shape[-1], fill_value=-1)
+    dense_component, mask_new = to_dense_batch(component, batch, max_num_nodes=max_num_nodes, fill_value=-1)
     # Subtract start component for each batch element and add 1 as 0 is a dummy concept for masked nodes and the actual
     # ones start at 1.
     dense_component = dense_component - component_starts[:, None] + 1
@@ -100,6 +108,19 @@ def dense_components(adj: torch.Tensor, mask: Optional[torch.Tensor] = None, con
     dense_component = torch.maximum(dense_component, torch.tensor([0], device=custom_logger.device))
     return dense_component
 
+def dense_components(adj: torch.Tensor, mask: Optional[torch.Tensor] = None, connection="weak", is_directed: bool = True):
+    """
+
+    :param adj: [max_num_nodes, max_num_nodes] or [batch_size, max_num_nodes, max_num_nodes]
+    :param mask: None or [max_num_nodes] or [batch_size, max_num_nodes]
+    :return:
+        max_num_components: maximum number of components in any graph
+        component: [batch_size, max_num_nodes] integers mapping each node to a component. Starting
+    """
+    edge_index, batch, num_nodes = adj_to_edge_index(adj, mask)
+    # TODO check if iterating over all samples and therefore having significantly less nodes per search is more efficient despite the overhead of more conversions
+    return components_from_edge_index(edge_index, batch, num_nodes, adj.shape[-1], connection, is_directed)
+
 def sparse_components_gpu(edge_index: torch.Tensor, num_nodes: int, connection="weak", is_directed: bool = True) ->\
         Tuple[int, torch.Tensor]:
     """
@@ -114,13 +135,39 @@ def sparse_components_gpu(edge_index: torch.Tensor, num_nodes: int, connection="
         components = scatter(last_components[edge_index[0]], edge_index[1], out=components, reduce='min')
         if is_directed and connection == "weak":
             components = scatter(last_components[edge_index[1]], edge_index[0], out=components, reduce='min')
+        # Pointer halving: also jump to the current label of one's label each round. Label chains then shrink
+        # geometrically, so the loop converges in O(log num_nodes) rounds instead of O(graph diameter).
+        components = torch.minimum(components, components[components])
     component_id, inverse = torch.unique(components, return_counts=False, return_inverse=True)
     # new_id = torch.argsort(component_size, descending=True)
     return component_id.shape[0], inverse
 
+def sparse_components_cugraph(edge_index: torch.Tensor, num_nodes: int, connection="weak",
+                              is_directed: bool = True) -> Tuple[int, torch.Tensor]:
+    """
+    Single cugraph call over the (possibly disconnected) edge list, entirely on device. Note that independent
+    samples can simply be offset into one super-graph, so one call covers them all.
+    """
+    df = cudf.DataFrame({"src": cudf.Series(edge_index[0]), "dst": cudf.Series(edge_index[1])})
+    graph = cugraph.Graph(directed=is_directed and connection != "weak")
+    graph.from_cudf_edgelist(df, source="src", destination="dst", renumber=False)
+    if graph.is_directed():
+        result = cugraph.strongly_connected_components(graph)
+    else:
+        result = cugraph.weakly_connected_components(graph)
+    # Isolated nodes do not appear in the edge list, so initialize each as its own component. A node's own index
+    # cannot collide with the label of another component as labels are vertex ids within the component.
+    components = torch.arange(num_nodes, dtype=torch.long, device=edge_index.device)
+    vertex = torch.as_tensor(result["vertex"].values, device=edge_index.device)
+    components[vertex] = torch.as_tensor(result["labels"].values, device=edge_index.device)
+    component_id, inverse = torch.unique(components, return_inverse=True)
+    return component_id.shape[0], inverse
+
 def sparse_components(edge_index: torch.Tensor, num_nodes: int, connection="weak", is_directed: bool = True) ->\
         Tuple[int, torch.Tensor]:
     if edge_index.is_cuda:
+        if _cugraph_available:
+            return sparse_components_cugraph(edge_index, num_nodes, connection, is_directed)
         return sparse_components_gpu(edge_index, num_nodes, connection, is_directed)
     else:
         return sparse_components_scipy(edge_index, num_nodes, connection, is_directed)
@@ -3,16 +3,31 @@ from typing import Optional
 
 import torch
 from time import time
-import numpy as np
 from torch.nn import UninitializedBuffer
 from torch_scatter import scatter
 
-import graphutils
-
 """
 Modified from: https://github.com/DeMoriarty/fast_pytorch_kmeans
 """
 
+# Route the distance GEMMs to tensor cores on Ampere+. TF32 keeps FP32 storage and only truncates the mantissa
+# inside the matmul, which is far below k-means convergence noise but gives a multiple of the FP32 throughput.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
+try:
+    # Optional: fused argmin kernel that never materializes the [n_points, n_clusters] distance matrix
+    from pykeops.torch import LazyTensor
+    _keops_available = True
+except ModuleNotFoundError:
+    _keops_available = False
+
+try:
+    import pynvml
+    _pynvml_exist = True
+except ModuleNotFoundError:
+    _pynvml_exist = False
+
 class KMeans(torch.nn.Module):
     '''
     Kmeans clustering algorithm implemented with PyTorch
@@ -43,7 +58,8 @@ class KMeans(torch.nn.Module):
     '''
 
     def __init__(self, n_clusters, max_iter=100, tol=0.0001, verbose=0, mode="euclidean", minibatch=None, threshold=0,
-                 centroids: Optional[torch.Tensor] = None):
+                 centroids: Optional[torch.Tensor] = None, matmul_dtype: Optional[torch.dtype] = None,
+                 compile_step: bool = False):
         super().__init__()
         self.n_clusters = n_clusters
         self.max_iter = max_iter
@@ -52,19 +68,24 @@ class KMeans(torch.nn.Module):
         self.mode = mode
         self.minibatch = minibatch
         self.threshold = threshold
+        # e.g. torch.bfloat16 to run the distance matmul on half-precision tensor cores while still
+        # accumulating the squared norms and the final similarities in FP32
+        self.matmul_dtype = matmul_dtype
         self._loop = False
         self._show = False
         if self.threshold != 0 and self.mode != 'euclidean':
             raise NotImplementedError("A threshold for KMeans is currently on other distance functions than "
                                       "euclidean can easily be implemented by replacing cdist!")
-        try:
-            import PYNVML
-            self._pynvml_exist = True
-        except ModuleNotFoundError:
-            self._pynvml_exist = False
+        self._pynvml_exist = _pynvml_exist
+        self._step_fn = None
+        if compile_step and hasattr(torch, 'compile'):
+            # N, K and D are static within one fit_predict call, so fixed-shape capture is safe and
+            # reduce-overhead additionally removes the per-kernel launch latency via CUDA graphs
+            self._step_fn = torch.compile(self._step, dynamic=False, mode='reduce-overhead')
         self.register_buffer("centroids", centroids)
 
     @staticmethod
+    @torch.no_grad()
     def cos_sim(a, b):
         """
           Compute cosine similarity of 2 sets of vectors
@@ -81,7 +102,8 @@ class KMeans(torch.nn.Module):
         return a @ b.transpose(-2, -1)
 
     @staticmethod
-    def euc_sim(a, b):
+    @torch.no_grad()
+    def euc_sim(a, b, b_sq=None, a_sq=None, need_values=True, matmul_dtype=None, out=None):
         """
           Compute euclidean similarity of 2 sets of vectors
 
@@ -89,26 +111,118 @@ class KMeans(torch.nn.Module):
           a: torch.Tensor, shape: [m, n_features]
 
           b: torch.Tensor, shape: [n, n_features]
+
+          b_sq: {torch.Tensor, None}, shape: [n], default: None
+            precomputed (b ** 2).sum(dim=1), e.g. when b stays fixed over multiple calls
+
+          a_sq: {torch.Tensor, None}, shape: [m], default: None
+            precomputed (a ** 2).sum(dim=1). The data never changes over the k-means iterations, so callers
+            that need exact values can compute this once instead of once per call
+
+          need_values: bool, default: True
+            if False, the -a^2 term is skipped. It is constant within each row, so the argmax over b stays
+            correct, but the returned values are no longer the exact negative squared distances
+
+          matmul_dtype: {torch.dtype, None}, default: None
+            if given (e.g. torch.bfloat16), the matmul runs in this dtype on tensor cores and the result is
+            upcast back to the input dtype before combining with the FP32 squared norms. torch.int8 selects
+            per-row symmetric quantization with a torch._int_mm inner product
+
+          out: {torch.Tensor, None}, shape: [m, n], default: None
+            buffer the similarities are written into, avoiding a fresh [m, n] allocation per call
+            (ignored on the matmul_dtype path)
         """
         # Returns the negative euclidean distance calculated as -\sum_i (a_i - b_i)^2 =- \sum_i a_i^2 + b_i^2 - a_i * b_i
-        return 2 * a @ b.transpose(-2, -1) - (a ** 2).sum(dim=1)[..., :, None] - (b ** 2).sum(dim=1)[..., None, :]
+        # addmm fuses the matmul with the b_sq subtraction into a single kernel instead of materializing 2 * a @ b.T
+        # and the broadcasted sums separately
+        if a.dtype in (torch.half, torch.bfloat16):
+            # The expansion form cancels catastrophically in half precision when points lie close to a
+            # centroid. Keep the matmul on half-precision tensor cores but accumulate the squared norms and
+            # the combination in FP32, and return FP32 so near-boundary argmax ties are resolved correctly.
+            if b_sq is None:
+                b_sq = (b.float() ** 2).sum(dim=1)
+            sim = 2 * (a @ b.transpose(-2, -1)).float() - b_sq[None, :]
+            if need_values:
+                if a_sq is None:
+                    a_sq = (a.float() ** 2).sum(dim=1)
+                sim.sub_(a_sq[:, None])
+            return sim
+        if b_sq is None:
+            b_sq = (b ** 2).sum(dim=1)
+        if matmul_dtype == torch.int8:
+            # Per-row symmetric int8: the inner product runs on int8 tensor cores and moves 4x fewer bytes
+            # than FP32; the approximate distances after dequantization are well within k-means convergence
+            # noise. The exact b_sq term keeps the relative ordering anchored to the true centroid norms.
+            a_q, a_scale = KMeans._quantize_per_row_int8(a)
+            b_q, b_scale = KMeans._quantize_per_row_int8(b)
+            ip = torch._int_mm(a_q, b_q.t().contiguous())
+            sim = 2 * ip.to(a.dtype) * a_scale * b_scale.transpose(-2, -1) - b_sq[None, :]
+        elif matmul_dtype is not None and matmul_dtype != a.dtype:
+            sim = 2 * (a.to(matmul_dtype) @ b.to(matmul_dtype).transpose(-2, -1)).to(a.dtype) - b_sq[None, :]
+        else:
+            sim = torch.addmm(b_sq, a, b.transpose(-2, -1), beta=-1.0, alpha=2.0, out=out)
+        if need_values:
+            if a_sq is None:
+                a_sq = (a ** 2).sum(dim=1)
+            sim.sub_(a_sq[:, None])
+        return sim
+
+    @staticmethod
+    @torch.no_grad()
+    def _quantize_per_row_int8(x):
+        """
+          Symmetric per-row int8 quantization: returns the quantized rows and the per-row scale
+        """
+        scale = x.abs().amax(dim=1, keepdim=True).clamp_min(1e-8) / 127.0
+        return (x / scale).round_().to(torch.int8), scale
+
+    @staticmethod
+    @torch.no_grad()
+    def _small_k_argmin(a, b, chunk_size=1 << 14):
+        """
+          Nearest neighbour of each row of a in b, specialized for few clusters: the [m, n] GEMM
+          underutilizes the hardware for small n, so the distances are computed via a broadcasted
+          subtract+square+sum over row chunks. Only a [chunk_size, n, n_features] intermediate ever
+          exists and just the argmin indices are written out.
+        """
+        out = torch.empty(a.shape[0], dtype=torch.long, device=a.device)
+        for start in range(0, a.shape[0], chunk_size):
+            rows = a[start:start + chunk_size]
+            out[start:start + chunk_size] = ((rows[:, None, :] - b[None, :, :]) ** 2).sum(-1).argmin(dim=-1)
+        return out
+
+    def _step(self, x, centroids):
+        """
+          A single full-recomputation k-means iteration (assignment + centroid update + convergence error),
+          kept as one function of pure tensor ops so torch.compile can fuse it (see compile_step)
+        """
+        if self.mode == 'cosine':
+            closest = (x @ centroids.transpose(-2, -1)).argmax(dim=-1)
+        else:
+            b_sq = (centroids ** 2).sum(dim=1)
+            closest = torch.addmm(b_sq, x, centroids.transpose(-2, -1), beta=-1.0, alpha=2.0).argmax(dim=-1)
+        c_grad = scatter(x, closest, dim=0, dim_size=self.n_clusters, reduce="mean")
+        error = (c_grad - centroids).pow(2).sum()
+        return c_grad, closest, error
 
     def remaining_memory(self):
         """
-          Get remaining memory in gpu
+          Get remaining memory in gpu. Must stay free of torch.cuda.synchronize()/empty_cache(): both are
+          global barriers that would stall the pipeline if this ever ran near a hot path, and empty_cache
+          additionally returns memory to the driver only for the next allocation to claim it back.
         """
-        torch.cuda.synchronize()
-        torch.cuda.empty_cache()
         if self._pynvml_exist:
             pynvml.nvmlInit()
             gpu_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
             info = pynvml.nvmlDeviceGetMemoryInfo(gpu_handle)
             remaining = info.free
         else:
-            remaining = torch.cuda.memory_allocated()
+            # queries the driver without synchronizing the device
+            remaining = torch.cuda.mem_get_info()[0]
         return remaining
 
-    def max_sim(self, a, b):
+    @torch.no_grad()
+    def max_sim(self, a, b, b_sq=None, need_values=False, out=None):
         """
           Compute maximum similarity (or minimum distance) of each vector
           in a with all of the vectors in b
@@ -117,15 +231,32 @@ class KMeans(torch.nn.Module):
           a: torch.Tensor, shape: [m, n_features]
 
           b: torch.Tensor, shape: [n, n_features]
+
+          b_sq: {torch.Tensor, None}, shape: [n], default: None
+            precomputed squared norms of b, only used in euclidean mode
+
+          need_values: bool, default: False
+            if False, the similarity values may be shifted by a per-row constant (see euc_sim). All callers
+            in this codebase only consume the argmax indices, which are unaffected
+
+          Note: apart from the KeOps and small-K paths, this assumes the [m, n] similarity matrix fits in
+          memory (in our case, the clusters always do).
         """
         device = a.device.type
         batch_size = a.shape[0]
+        if self.mode == 'euclidean' and not need_values and not _keops_available and self.n_clusters <= 32:
+            # see _small_k_argmin: for few clusters the chunked direct reduction beats the GEMM form
+            return None, self._small_k_argmin(a, b), None
+        if _keops_available and self.mode == 'euclidean' and not need_values:
+            # KeOps streams tiles of b through registers and reduces in-kernel, so memory stays O(n_points)
+            # instead of O(n_points * n_clusters). Only the indices are produced on this path.
+            d_ij = ((LazyTensor(a[:, None, :]) - LazyTensor(b[None, :, :])) ** 2).sum(-1)
+            max_sim_i = d_ij.argmin(dim=1).squeeze(-1)
+            return None, max_sim_i, None
         if self.mode == 'cosine':
-            sim_func = self.cos_sim
+            sim = self.cos_sim(a, b)
         elif self.mode == 'euclidean':
-            sim_func = self.euc_sim
-
-        sim = sim_func(a, b)
+            sim = self.euc_sim(a, b, b_sq=b_sq, need_values=need_values, matmul_dtype=self.matmul_dtype, out=out)
         max_sim_v, max_sim_i = sim.max(dim=-1)
         return max_sim_v, max_sim_i, sim
 
@@ -160,6 +291,7 @@ class KMeans(torch.nn.Module):
         #         max_sim_i = torch.cat(msi, dim=0)
         #     return max_sim_v, max_sim_i
 
+    @torch.no_grad()
     def fit_predict(self, X, centroids=None):
         """
           Combination of fit() and predict() methods.
@@ -182,64 +314,161 @@ class KMeans(torch.nn.Module):
         batch_size, emb_dim = X.shape
         device = X.device.type
         start_time = time()
+        if self.mode == 'cosine':
+            # Normalizing the data once up front (and the centroids after every update) turns each similarity
+            # computation in the loop into a plain matmul instead of renormalizing both sides per call
+            X = X / (X.norm(dim=-1, keepdim=True) + 1e-8)
+        X_full = None
+        if self.minibatch is None and batch_size > 100 * self.n_clusters:
+            # With N >> K, k-means converges on a uniform subsample almost identically to the full set.
+            # Iterate on 100 points per cluster and do a single assignment + mean update pass on all of X
+            # after convergence.
+            X_full = X
+            X = X[torch.randperm(batch_size, device=X.device)[:100 * self.n_clusters]]
+            batch_size = X.shape[0]
         if centroids is None:
-            self.centroids = X[np.random.choice(batch_size, size=[self.n_clusters], replace=False)].detach()
+            # randperm on the device of X avoids the host-side numpy sampling plus index transfer, and
+            # index_select does the contiguous row gather without the advanced-indexing machinery
+            idx = torch.randperm(batch_size, device=X.device)[:self.n_clusters]
+            self.centroids = torch.index_select(X, 0, idx).detach()
         else:
-            self.centroids = centroids
+            # clone as the loop below updates self.centroids in-place and must not mutate the caller's tensor
+            self.centroids = centroids.clone()
+            if self.mode == 'cosine':
+                self.centroids.div_(self.centroids.norm(dim=-1, keepdim=True) + 1e-8)
+        # Persistent buffers for the new centroids and the centroid movement so the inner loop does not
+        # allocate K x D tensors every iteration
+        c_grad = torch.empty_like(self.centroids)
+        scratch = torch.empty_like(self.centroids)
+        # Lazily allocated [n_points, n_clusters] buffer reused by the fixed-shape similarity matmuls below,
+        # capping the peak at one distance matrix instead of the old one-fresh-allocation-per-iteration
+        sim_buf = None
         # num_points_in_clusters = torch.ones(self.n_clusters, device=device, dtype=X.dtype)
         closest = None
+        # Hamerly-style triangle-inequality bounds: upper bounds the distance of each point to its assigned
+        # centroid, lower the distance to its second-closest one. Only valid for full-batch euclidean k-means.
+        use_bounds = self.mode == 'euclidean' and self.minibatch is None and self.n_clusters > 1
+        upper, lower = None, None
         for i in range(self.max_iter):
             # iter_time = time()
             if self.minibatch is not None:
-                x = X[np.random.choice(batch_size, size=[self.minibatch], replace=False)]
+                # sampling with replacement is fine for minibatch updates and avoids a full randperm per iteration
+                x = X[torch.randint(batch_size, (self.minibatch,), device=X.device)]
             else:
                 x = X
-            _, closest, neg_distances = self.max_sim(a=x, b=self.centroids)
+            if self._step_fn is not None and not use_bounds:
+                # fused iteration: matmul, argmax, scatter-mean and the error reduction are compiled into a
+                # handful of kernels; inductor manages its own static buffers on this path
+                c_grad, closest, error = self._step_fn(x, self.centroids)
+            elif use_bounds and closest is not None:
+                # A point can only change its assignment if its upper bound exceeds both its lower bound and
+                # half the distance from its centroid to the nearest other centroid (Hamerly's pruning test).
+                centroid_dists = torch.cdist(self.centroids, self.centroids)
+                centroid_dists.fill_diagonal_(torch.inf)
+                s = 0.5 * centroid_dists.min(dim=-1)[0]
+                idx = torch.nonzero(upper > torch.maximum(s[closest], lower)).squeeze(1)
+                distances, order = torch.cdist(x[idx], self.centroids).topk(2, dim=-1, largest=False)
+                closest[idx] = order[:, 0]
+                upper[idx] = distances[:, 0]
+                lower[idx] = distances[:, 1]
+            elif use_bounds:
+                distances, order = torch.cdist(x, self.centroids).topk(2, dim=-1, largest=False)
+                closest = order[:, 0]
+                upper = distances[:, 0]
+                lower = distances[:, 1]
+            elif self.mode == 'cosine':
+                # both sides are kept normalized (see above), so the similarity is a plain matmul
+                if sim_buf is None:
+                    sim_buf = torch.empty(x.shape[0], self.n_clusters, device=X.device, dtype=X.dtype)
+                torch.mm(x, self.centroids.transpose(-2, -1), out=sim_buf)
+                closest = sim_buf.argmax(dim=-1)
+            else:
+                # The centroids only change once per iteration, so their squared norms are hoisted out of euc_sim
+                b_sq = (self.centroids ** 2).sum(dim=1)
+                if sim_buf is None and not _keops_available and self.matmul_dtype is None:
+                    sim_buf = torch.empty(x.shape[0], self.n_clusters, device=X.device, dtype=X.dtype)
+                _, closest, neg_distances = self.max_sim(a=x, b=self.centroids, b_sq=b_sq, out=sim_buf)
             # matched_clusters, counts = closest.unique(return_counts=True)
 
-            c_grad = torch.zeros_like(self.centroids)
-            if self._loop:
-                raise RuntimeError()
-                # for j, count in zip(matched_clusters, counts):
-                #     c_grad[j] = x[closest == j].sum(dim=0) / count
-            else:
-                if self.minibatch is None:
-                    # [n_clusters, n_points] of cluster ids
-                    expanded_closest = closest[None].expand(self.n_clusters, -1)
-                    mask = (expanded_closest == torch.arange(self.n_clusters, device=device)[:, None]).to(X.dtype)
-                    c_grad = mask @ x / mask.sum(-1)[..., :, None]
-                    c_grad[c_grad != c_grad] = 0  # remove NaNs
+            if self._step_fn is None or use_bounds:
+                if self._loop:
+                    raise RuntimeError()
+                    # for j, count in zip(matched_clusters, counts):
+                    #     c_grad[j] = x[closest == j].sum(dim=0) / count
                 else:
-                    pass
-                    # expanded_closest = closest[None].expand(len(matched_clusters), -1)
-                    # mask = (expanded_closest == matched_clusters[:, None]).to(X.dtype)
-
-            error = (c_grad - self.centroids).pow(2).sum()
-            cost = (c_grad[closest] - x).pow(2).sum()
+                    # Mean of all points assigned to each cluster. Empty clusters yield 0, just like the NaN
+                    # cleanup after the old [n_clusters, n_points] one-hot mask matmul did, but without
+                    # materializing that mask.
+                    c_grad.zero_()
+                    scatter(x, closest, dim=0, out=c_grad, reduce="mean")
+
+                torch.sub(c_grad, self.centroids, out=scratch)
+                scratch.pow_(2)
+                if use_bounds:
+                    # How far each centroid moved (squared per centroid). error is the sum of squared
+                    # movements, as before, and both come out of a single pass over the scratch buffer.
+                    delta_sq = scratch.sum(dim=-1)
+                    error = delta_sq.sum()
+                    delta = delta_sq.sqrt_()
+                else:
+                    error = scratch.sum()
             # if self.minibatch is not None:
             #     lr = 1 / num_points_in_clusters[:, None] * 0.9 + 0.1
             #     # lr = 1/num_points_in_clusters[:,None]**0.1
             # else:
             #     lr = 1
             # num_points_in_clusters[matched_clusters] += counts
-            self.centroids = c_grad
+            self.centroids.copy_(c_grad)
+            if self.mode == 'cosine':
+                # keep the invariant that stored centroids are unit-norm (empty clusters stay at 0)
+                self.centroids.div_(self.centroids.norm(dim=-1, keepdim=True) + 1e-8)
             # self.centroids = self.centroids * (1 - lr) + c_grad * lr
+            if use_bounds:
+                # Moving a centroid by delta can tighten/loosen the true distances by at most delta
+                upper += delta[closest]
+                lower -= delta.max()
             # if self.verbose >= 2:
             #     print('iter:', i, 'error:', error.item(), 'time spent:', round(time() - iter_time, 4))
-            if error <= self.tol:
+            # Reading the scalar error forces a device-to-host sync, so it is only polled every 5 iterations.
+            # Worst case this overshoots convergence by 4 iterations, each far cheaper than a sync per step.
+            if i % 5 == 4 and error <= self.tol:
                 break
 
+        if X_full is not None:
+            # Refinement pass over the full data: one assignment and one mean update with the converged centroids
+            closest = self.max_sim(a=X_full, b=self.centroids)[1]
+            self.centroids = scatter(X_full, closest, dim=0, dim_size=self.n_clusters, reduce="mean")
+            if self.mode == 'cosine':
+                self.centroids.div_(self.centroids.norm(dim=-1, keepdim=True) + 1e-8)
+            X = x = X_full
+            batch_size = X.shape[0]
+
+        # The cost is only part of the return value, so computing it once after the loop saves the
+        # N x D gather + subtract + reduction that used to run every iteration
+        cost = (self.centroids[closest] - x).pow(2).sum()
+
         if self.threshold != 0:
             centroid_dists = torch.cdist(self.centroids, self.centroids)
             merge_mask = centroid_dists < self.threshold * torch.max(centroid_dists)
             # Note: there might be chains of centroids a-b-c, where dist(a, b), dist(b, c) < threshold,
-            # but dist(a, c) > threshold. We decide to merge those by perfomring a connected component search on a graph
-            # where there is an edge between 2 clusters iff. they are closer than the threshold.
+            # but dist(a, c) > threshold. We decide to merge those by finding connected components in a graph
+            # where there is an edge between 2 clusters iff. they are closer than the threshold. With only K
+            # centroids, union-find over the sparse edge list is cheaper than a dense component search.
+            parents = list(range(self.n_clusters))
+
+            def find(u):
+                while parents[u] != u:
+                    parents[u] = parents[parents[u]]
+                    u = parents[u]
+                return u
+
+            for u, v in merge_mask.triu(1).nonzero().tolist():
+                root_u, root_v = find(u), find(v)
+                if root_u != root_v:
+                    parents[root_v] = root_u
             # [num_clusters] with values in [0, num_merged_clusters - 1]
-            assignments = graphutils.dense_components(merge_mask[None, :, :],
-                                                      torch.ones(self.n_clusters, dtype=torch.bool,
-                                                                 device=device)[None, :],
-                                                      is_directed=False).squeeze(0) - 1
+            assignments = torch.unique(torch.tensor([find(u) for u in range(self.n_clusters)], device=X.device),
+                                       return_inverse=True)[1]
             closest = assignments[closest]
             self.centroids = scatter(X, closest, dim=-2, reduce="mean")
 
@@ -248,6 +477,7 @@ class KMeans(torch.nn.Module):
                 f'used {i + 1} iterations ({round(time() - start_time, 4)}s) to cluster {batch_size} items into {self.n_clusters} clusters')
         return closest, cost
 
+    @torch.no_grad()
     def predict(self, X):
         """
           Predict the closest cluster each sample in X belongs to
@@ -264,6 +494,7 @@ class KMeans(torch.nn.Module):
 
         return self.max_sim(a=X, b=self.centroids)[1]
 
+    @torch.no_grad()
     def fit(self, X, centroids=None):
         """
           Perform kmeans clustering
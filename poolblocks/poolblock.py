@@ -3,19 +3,16 @@ import abc
 import json
 import typing
 import warnings
-from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from typing import List
 
-import networkx as nx
 import torch
 import torch.nn.functional as F
 import wandb
 from functorch import vmap
-from torch.distributions import Categorical
 from torch_geometric.data import Data
 from torch_geometric.nn import dense_diff_pool, DenseGCNConv
-from torch_geometric.utils import add_remaining_self_loops, to_dense_batch, k_hop_subgraph, to_networkx
+from torch_geometric.utils import add_remaining_self_loops, to_dense_batch
 from torch_scatter import scatter
 
 import clustering_wrappers
@@ -29,7 +26,6 @@ from custom_logger import log
 from data_generation import deserializer
 from graphutils import adj_to_edge_index
 from poolblocks.custom_asap import ASAPooling
-import networkx.algorithms.isomorphism as iso
 
 from typing import TYPE_CHECKING
 
@@ -38,6 +34,13 @@ from poolblocks.perturbing_distributions import PerturbingDistribution
 if TYPE_CHECKING:
     from custom_net import CustomNet
 
+# Compile the Gumbel-max sampling chain in _generate_assignments into a single fused kernel. Off by default:
+# for the small graphs we typically pool, the CUDA-graph/compile overhead outweighs the fusion gain.
+COMPILE_SOFTSAMPLE = False
+# Compile the embedding conv stacks so each conv + bias + activation becomes one fused kernel instead of a
+# launch per op. Off by default for the same reason as above.
+COMPILE_CONV_STACKS = False
+
 class PoolBlock(torch.nn.Module, abc.ABC):
     def __init__(self, embedding_sizes: List[int], conv_type=DenseGCNConv,
                  activation_function=F.relu, forced_embeddings=None, directed_graphs: bool = True, **kwargs):
@@ -46,6 +49,17 @@ class PoolBlock(torch.nn.Module, abc.ABC):
         self.activation_function = activation_function
         self.embedding_sizes = embedding_sizes
         self.directed_graphs = directed_graphs
+        self._embed_fn = torch.compile(self._embed, mode="reduce-overhead")\
+            if COMPILE_CONV_STACKS and hasattr(torch, "compile") else self._embed
+
+    def _embed(self, x: torch.Tensor, adj_or_edge_index: torch.Tensor, mask_or_weights=None) -> torch.Tensor:
+        """
+        Runs the embedding conv stack. The third conv argument is the mask for dense convs and the edge weights
+        for sparse ones, so the same runner (and its compiled variant) serves both layouts.
+        """
+        for conv in self.embedding_convs:
+            x = self.activation_function(conv(x, adj_or_edge_index, mask_or_weights))
+        return x
 
     @abc.abstractmethod
     def forward(self, x: torch.Tensor, adj_or_edge_index: torch.Tensor, mask_or_batch=None,
@@ -73,6 +87,13 @@ class PoolBlock(torch.nn.Module, abc.ABC):
     def log_data(self, epoch: int, index: int):
         pass
 
+    def _forced(self, x: torch.Tensor, out_dim: int) -> torch.Tensor:
+        """
+        Constant node embeddings for the forced_embeddings path. new_full writes the constant directly
+        instead of allocating a ones tensor and multiplying it.
+        """
+        return x.new_full(x.shape[:-1] + (out_dim,), self.forced_embeddings)
+
     def log_assignments(self, model: CustomNet, data: Data, num_graphs_to_log: int, epoch: int):
         pass
 
@@ -104,10 +125,9 @@ class DenseNoPoolBlock(PoolBlock):
 
     def forward(self, x: torch.Tensor, adj: torch.Tensor, mask=None, edge_weights=None):
         if self.forced_embeddings is not None:
-            x = torch.ones(x.shape[:-1] + (self.output_dim,), device=x.device) * self.forced_embeddings
+            x = self._forced(x, self.output_dim)
         else:
-            for conv in self.embedding_convs:
-                x = self.activation_function(conv(x, adj, mask))
+            x = self._embed_fn(x, adj, mask)
         return x, adj, None, None, 0, None, None, x, mask
 
 
@@ -124,33 +144,55 @@ class SparseNoPoolBlock(PoolBlock):
 
     def forward(self, x: torch.Tensor, edge_index: torch.Tensor, batch=None, edge_weights=None):
         if self.forced_embeddings is not None:
-            x = torch.ones(x.shape[:-1] + (self.output_dim,), device=x.device) * self.forced_embeddings
+            x = self._forced(x, self.output_dim)
         else:
-            for conv in self.embedding_convs:
-                x = self.activation_function(conv(x, edge_index, edge_weights))
+            x = self._embed_fn(x, edge_index, edge_weights)
         return x, edge_index, None, None, 0, None, None, x, batch
 
 
 class DiffPoolBlock(PoolBlock):
     def __init__(self, embedding_sizes: List[int], conv_type=DenseGCNConv,
-                 activation_function=F.relu, forced_embeddings=None, num_output_nodes: int = -1, **kwargs):
+                 activation_function=F.relu, forced_embeddings=None, num_output_nodes: int = -1,
+                 share_pool_embedding_convs: bool = True, **kwargs):
         """
 
         :param sizes: [input_size, hidden_size1, hidden_size2, ..., output_size]
+        :param share_pool_embedding_convs: share all but the last conv layer between the embedding and pooling
+            branches. Halves the conv compute and activation memory; set to False for the original two
+            independent stacks.
         """
         super().__init__(embedding_sizes, conv_type, activation_function, forced_embeddings)
-        # Sizes of layers for generating the pooling embedding could be chosen completely arbitrary.
-        # Sharing the first layers and only using a different one for the last layer would be imaginable, too.
-        pool_sizes = embedding_sizes.copy()
         self.num_output_nodes = num_output_nodes
-        pool_sizes[-1] = num_output_nodes
-
-        self.embedding_convs = torch.nn.ModuleList()
-        self.pool_convs = torch.nn.ModuleList()
-        for i in range(len(embedding_sizes) - 1):
+        self.share_pool_embedding_convs = share_pool_embedding_convs
+        if share_pool_embedding_convs:
+            # Both branches run over the same adjacency, so all but the last layer can be computed once.
             # Using DenseGCNConv so I can use adjacency matrix instead of edge_index and don't have to convert back and forth for DiffPool https://github.com/pyg-team/pytorch_geometric/issues/881
-            self.embedding_convs.append(conv_type(embedding_sizes[i], embedding_sizes[i + 1]))
-            self.pool_convs.append(conv_type(pool_sizes[i], pool_sizes[i + 1]))
+            self.shared_convs = torch.nn.ModuleList(
+                [conv_type(embedding_sizes[i], embedding_sizes[i + 1]) for i in range(len(embedding_sizes) - 2)])
+            self.embedding_head = conv_type(embedding_sizes[-2], embedding_sizes[-1])
+            self.pool_head = conv_type(embedding_sizes[-2], num_output_nodes)
+        else:
+            # Sizes of layers for generating the pooling embedding could be chosen completely arbitrary.
+            pool_sizes = embedding_sizes.copy()
+            pool_sizes[-1] = num_output_nodes
+
+            self.embedding_convs = torch.nn.ModuleList()
+            self.pool_convs = torch.nn.ModuleList()
+            for i in range(len(embedding_sizes) - 1):
+                # Using DenseGCNConv so I can use adjacency matrix instead of edge_index and don't have to convert back and forth for DiffPool https://github.com/pyg-team/pytorch_geometric/issues/881
+                self.embedding_convs.append(conv_type(embedding_sizes[i], embedding_sizes[i + 1]))
+                self.pool_convs.append(conv_type(pool_sizes[i], pool_sizes[i + 1]))
+
+    @staticmethod
+    def _node_validity(adj: torch.Tensor, mask: typing.Optional[torch.Tensor]):
+        """
+        [batch_size, num_nodes, 1] that is 1 iff the node is valid. The mask encodes this directly; the O(N^2)
+        row max over the adjacency is only the fallback when no mask is given (and also zeroed out valid but
+        isolated nodes, e.g. single-node graphs).
+        """
+        if mask is not None:
+            return mask[:, :, None].to(adj.dtype)
+        return torch.max(adj, dim=1)[0][:, :, None]
 
     def forward(self, x: torch.Tensor, adj: torch.Tensor, mask=None, edge_weights=None):
         """
@@ -159,31 +201,37 @@ class DiffPoolBlock(PoolBlock):
         :return:
         """
         embedding, pool = x, x
-        if self.forced_embeddings is None:
-            for conv in self.embedding_convs:
-                # print("i", embedding.shape, adj.shape)
-                embedding = self.activation_function(conv(embedding, adj, mask))
-                # embedding = F.dropout(embedding, training=self.training)
-
-            # Don't need the softmax part from http://arxiv.org/abs/2207.13586 as my concepts are determined by the clusters
-            # we map to. These could be found using embeddings (separately learned as here in DiffPool or just the normal
-            # ones) but don't have to (like in DiffPool)
-            # embedding = F.softmax(self.embedding_convs[-1](embedding, adj), dim=1)
-            # max_vals, _ = torch.max(embedding, dim=1, keepdim=True)
-            # embedding = embedding / max_vals
+        if self.share_pool_embedding_convs:
+            hidden = x
+            for conv in self.shared_convs:
+                hidden = self.activation_function(conv(hidden, adj, mask))
+            if self.forced_embeddings is None:
+                embedding = self.activation_function(self.embedding_head(hidden, adj, mask))
+            else:
+                embedding = self.forced_embeddings * self._node_validity(adj, mask)
+            pool = self.pool_head(hidden, adj)
         else:
-            # [batch_size, num_nodes, 1] that is 1 iff node has any neighbours
-            # TODO:
-            #   1. Note this also means I overwrite graphs with a single node with 0 instead of one. I suppose, I should
-            #      rather use the mask
-            #   2. Change feature dimension to size of final layer to make this compatible with poolblocks that change
-            #      dimension (which should be basically all, wtf)
-            embedding = self.forced_embeddings * torch.max(adj, dim=1)[0][:, :, None]
-
-        for conv in self.pool_convs[:-1]:
-            pool = self.activation_function(conv(pool, adj))
-            # pool = F.dropout(pool, training=self.training)
-        pool = self.pool_convs[-1](pool, adj)
+            if self.forced_embeddings is None:
+                for conv in self.embedding_convs:
+                    # print("i", embedding.shape, adj.shape)
+                    embedding = self.activation_function(conv(embedding, adj, mask))
+                    # embedding = F.dropout(embedding, training=self.training)
+
+                # Don't need the softmax part from http://arxiv.org/abs/2207.13586 as my concepts are determined by the clusters
+                # we map to. These could be found using embeddings (separately learned as here in DiffPool or just the normal
+                # ones) but don't have to (like in DiffPool)
+                # embedding = F.softmax(self.embedding_convs[-1](embedding, adj), dim=1)
+                # max_vals, _ = torch.max(embedding, dim=1, keepdim=True)
+                # embedding = embedding / max_vals
+            else:
+                # TODO: Change feature dimension to size of final layer to make this compatible with poolblocks
+                #  that change dimension (which should be basically all, wtf)
+                embedding = self.forced_embeddings * self._node_validity(adj, mask)
+
+            for conv in self.pool_convs[:-1]:
+                pool = self.activation_function(conv(pool, adj))
+                # pool = F.dropout(pool, training=self.training)
+            pool = self.pool_convs[-1](pool, adj)
 
         # TODO try dividing the softmax by its maximum value similar to the concepts
         # print(embedding.shape, edge_index.shape, pool.shape) [batch_nodes, num_features] [2, ?] []
@@ -194,9 +242,11 @@ class DiffPoolBlock(PoolBlock):
         return new_embeddings, new_adj, None, None, loss_l + loss_e, pool, pool, embedding, mask
 
     def log_assignments(self, model: CustomNet, data: Data, num_graphs_to_log: int, epoch: int):
-        node_table = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "label", "activations"])
-        edge_table = wandb.Table(["graph", "pool_step", "source", "target"])
-        device = self.embedding_convs[0].bias.device
+        # rows are accumulated in Python lists and converted in bulk: per-cell .item() calls would trigger one
+        # device sync each and dominate the logging time for large graphs
+        node_rows = []
+        edge_rows = []
+        device = custom_logger.device
         with torch.no_grad():
             data = data.clone().detach().to(device)
             out, _, concepts, _, info = model(data, collect_info=True)
@@ -205,30 +255,31 @@ class DiffPoolBlock(PoolBlock):
             for graph_i in range(num_graphs_to_log):
 
                 for pool_step, assignment in enumerate(pool_assignments[:1]):
-                    num_nodes = data.num_nodes[graph_i]
+                    num_nodes = int(data.num_nodes[graph_i])
                     # [num_nodes, num_clusters]
                     assignment = torch.softmax(assignment[graph_i], dim=-1)  # usually performed by diffpool function
                     assignment = assignment.detach().cpu().squeeze(0)  # remove batch dimensions
                     ColorUtils.ensure_min_rgb_colors(assignment.shape[1] + 1)
-                    # [num_nodes, 3] (intermediate dimensions: num_nodes x num_clusters x 3)
-                    colors = torch.sum(assignment[:, :, None] * ColorUtils.rgb_colors[None, :assignment.shape[1], :],
-                                       dim=1)[:num_nodes, :]
-                    colors = torch.round(colors * 255).to(int)
-                    for i in range(num_nodes):
-                        node_table.add_data(graph_i, pool_step, i, colors[i, 0].item(),
-                                            colors[i, 1].item(), colors[i, 2].item(),
-                                            ", ".join([f"{m.item() * 100:.0f}%" for m in assignment[i].cpu()]),
-                                            ", ".join([f"{m.item():.2f}" for m in
-                                                       pool_activations[pool_step][graph_i, i, :].cpu()]))
+                    # [num_nodes, 3] as a single matmul instead of materializing num_nodes x num_clusters x 3
+                    colors = assignment[:num_nodes].to(ColorUtils.rgb_colors.dtype)\
+                             @ ColorUtils.rgb_colors[:assignment.shape[1]]
+                    colors = torch.round(colors * 255).to(int).tolist()
+                    assignment_list = assignment[:num_nodes].tolist()
+                    activations_list = pool_activations[pool_step][graph_i, :num_nodes, :].cpu().tolist()
+                    node_rows += [[graph_i, pool_step, i, colors[i][0], colors[i][1], colors[i][2],
+                                   ", ".join([f"{m * 100:.0f}%" for m in assignment_list[i]]),
+                                   ", ".join([f"{m:.2f}" for m in activations_list[i]])]
+                                  for i in range(num_nodes)]
 
                     # [3, num_edges] where the first row seems to be constant 0, indicating the graph membership
                     edge_index, _, _ = adj_to_edge_index(data.adj[graph_i], data.mask[graph_i:graph_i+1] if hasattr(data, "mask") else None)
-                    for i in range(edge_index.shape[1]):
-                        edge_table.add_data(graph_i, pool_step, edge_index[0, i].item(), edge_index[1, i].item())
+                    edge_rows += [[graph_i, pool_step, source, target] for source, target in
+                                  edge_index.t().cpu().tolist()]
         log(dict(
             # graphs_table=graphs_table
-            node_table=node_table,
-            edge_table=edge_table
+            node_table=wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "label", "activations"],
+                                   data=node_rows),
+            edge_table=wandb.Table(["graph", "pool_step", "source", "target"], data=edge_rows)
         ), step=epoch)
 
 
@@ -261,33 +312,51 @@ class ASAPBlock(PoolBlock):
     def forward(self, x: torch.Tensor, edge_index: torch.Tensor, batch=None, edge_weights=None):
 
         if self.forced_embeddings is None:
-            for conv in self.embedding_convs:
-                # print(x.shape, edge_index.shape)
-                x = self.activation_function(conv(x, edge_index, edge_weight=edge_weights))
+            x = self._embed_fn(x, edge_index, edge_weights)
         else:
-            x = torch.ones(x.shape[:-1] + (self.num_output_features,), device=x.device) * self.forced_embeddings
+            x = self._forced(x, self.num_output_features)
         new_x, edge_index, new_edge_weight, batch, perm, fitness, score = self.asap(x=x, edge_index=edge_index,
                                                                                     batch=batch,
                                                                                     edge_weight=edge_weights)
         return new_x, edge_index, new_edge_weight, None, 0, (perm, fitness, score), None, x, batch
 
     def log_assignments(self, model: CustomNet, all_data: Data, num_graphs_to_log: int, epoch: int):
-        node_table = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_strength", "border_color",
-                                  "label", "activations"])
-        edge_table = wandb.Table(["graph", "pool_step", "source", "target", "strength"])  # , "label", "strength"
-        device = self.embedding_convs[0].bias.device
+        # rows are accumulated in Python lists and converted in bulk: per-cell .item() calls would trigger one
+        # device sync each and dominate the logging time for large graphs
+        node_rows = []
+        edge_rows = []
+        device = custom_logger.device
         with torch.no_grad():
+            # Per-graph node and edge ranges computed once: scanning all_data.batch and all edge values again
+            # for every logged graph would be O(num_graphs_to_log * batch). Edges are grouped by graph in a
+            # PyG batch, so one bincount each suffices.
+            node_counts = torch.bincount(all_data.batch, minlength=num_graphs_to_log).cpu()
+            node_offsets = torch.cat((torch.zeros(1, dtype=torch.long), node_counts.cumsum(0)))
+            edge_counts = torch.bincount(all_data.batch[all_data.edge_index[0]],
+                                         minlength=num_graphs_to_log).cpu()
+            edge_offsets = torch.cat((torch.zeros(1, dtype=torch.long), edge_counts.cumsum(0)))
+            # Self loops for all graphs in one call instead of one launch per graph. The block appended by
+            # add_remaining_self_loops is sorted by node index, so each graph's loops are a contiguous slice of
+            # it that searchsorted can locate.
+            total_edges = all_data.edge_index.shape[1]
+            edge_index_with_loops, _ = add_remaining_self_loops(all_data.edge_index, fill_value=1.,
+                                                                num_nodes=int(all_data.num_nodes))
+            loop_nodes = edge_index_with_loops[0, total_edges:].cpu()
             for graph_i in range(num_graphs_to_log):
-                mask = all_data.batch == graph_i
-                start_index = torch.arange(mask.shape[0])[mask][0]
-                num_nodes = torch.sum(mask)
+                start_index = int(node_offsets[graph_i])
+                num_nodes = int(node_counts[graph_i])
                 data = Data(x=all_data.x[start_index:start_index+num_nodes],
-                            edge_index=all_data.edge_index[:,
-                                       torch.logical_and(all_data.edge_index[0] >= start_index,
-                                                         all_data.edge_index[0] < start_index + num_nodes)] - start_index,
+                            edge_index=all_data.edge_index[:, edge_offsets[graph_i]:edge_offsets[graph_i + 1]]
+                                       - start_index,
                             num_nodes=num_nodes)
-                edge_index = data.edge_index.detach().clone()
-                edge_index, _ = add_remaining_self_loops(edge_index, fill_value=1., num_nodes=data.num_nodes)
+                # original edges followed by the graph's missing self loops in node order: the same layout
+                # add_remaining_self_loops produces per graph (and ASAPooling relies on internally)
+                loop_start, loop_end = torch.searchsorted(
+                    loop_nodes, torch.tensor([start_index, start_index + num_nodes])).tolist()
+                edge_index = torch.cat(
+                    (data.edge_index,
+                     edge_index_with_loops[:, total_edges + loop_start:total_edges + loop_end] - start_index),
+                    dim=1)
 
                 data = data.clone().detach().to(device)
                 num_nodes = data.num_nodes  # note that this will be changed to tensor in model call
@@ -312,88 +381,214 @@ class ASAPBlock(PoolBlock):
                     colors = scatter(color_to_edge, edge_index[0], dim=0, reduce='sum')
                     colors[perm, :] = ColorUtils.rgb_colors[:perm.shape[
                         0]]  # Make sure the selected nodes actually have their color (with full opacity)
-                    for i in range(num_nodes):
-                        node_table.add_data(graph_i, pool_step, i, colors[i, 0].item(),
-                                            colors[i, 1].item(), colors[i, 2].item(),
-                                            2 * fitness[i].item(),
-                                            "#F00" if i in perm else "#000",
-                                            f"fitness: {fitness[i].item(): .3f}",
-                                            ", ".join([f"{m.item():.2f}" for m in
-                                                       pool_activations[pool_step][i, :].cpu()]))
+                    colors_list = colors.tolist()
+                    fitness_list = fitness.tolist()
+                    perm_set = set(perm.tolist())
+                    activations_list = pool_activations[pool_step][:num_nodes].cpu().tolist()
+                    node_rows += [[graph_i, pool_step, i, colors_list[i][0], colors_list[i][1], colors_list[i][2],
+                                   2 * fitness_list[i],
+                                   "#F00" if i in perm_set else "#000",
+                                   f"fitness: {fitness_list[i]: .3f}",
+                                   ", ".join([f"{m:.2f}" for m in activations_list[i]])]
+                                  for i in range(num_nodes)]
 
                     # [3, num_edges] where the first row seems to be constant 0, indicating the graph membership
-                    for i in range(edge_index.shape[1]):
-                        edge_table.add_data(graph_i, pool_step, edge_index[0, i].item(), edge_index[1, i].item(),
-                                            2 * score[i].item())
+                    score_list = (2 * score).tolist()
+                    edge_rows += [[graph_i, pool_step, source, target, score_list[i]]
+                                  for i, (source, target) in enumerate(edge_index.t().tolist())]
         log(dict(
             # graphs_table=graphs_table
-            node_table=node_table,
-            edge_table=edge_table
+            node_table=wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_strength",
+                                    "border_color", "label", "activations"], data=node_rows),
+            edge_table=wandb.Table(["graph", "pool_step", "source", "target", "strength"], data=edge_rows)
         ), step=epoch)
 
-def _calculate_local_clusters_scipy(concepts: torch.Tensor, adj: torch.Tensor, mask: torch.Tensor, is_directed: bool) -> torch.Tensor:
+def _pairwise_dist(a: torch.Tensor, b: torch.Tensor, squared: bool = False) -> torch.Tensor:
+    """
+    Euclidean distances via ||a||^2 + ||b||^2 - 2ab^T: a single GEMM instead of the pairwise expansion
+    torch.cdist can fall back to, and without its backward memory blowup (only used under no_grad anyway).
+
+    :param a: [..., n, d]
+    :param b: [..., m, d]
+    :param squared: skip the final sqrt; enough wherever only the ranking of distances matters
+    :return: [..., n, m]
+    """
+    res = (a * a).sum(-1, keepdim=True) + (b * b).sum(-1) - 2 * a @ b.transpose(-1, -2)
+    res.clamp_min_(0)  # the expanded form can go slightly negative for (near-)identical points
+    return res if squared else res.sqrt_()
+
+def _wl_signature(concepts: torch.Tensor, edge_index: torch.Tensor, num_iterations: int = 3) -> tuple:
+    """
+    Weisfeiler-Lehman color refinement in tensor form. Each round replaces a node's label by a compact id for
+    (own label, histogram of in-neighbour labels, histogram of out-neighbour labels); torch.unique over the rows
+    assigns those ids in sorted row order, so the returned sorted label multiset only depends on the isomorphism
+    class of the concept-labelled graph, never on node order.
+
+    :param concepts: [num_nodes] initial integer labels
+    :param edge_index: [2, num_edges] over the same node indices (both directions present for undirected graphs)
+    :return: hashable tuple of the final labels, sorted
+    """
+    labels = concepts
+    src, dst = edge_index[0], edge_index[1]
+    num_nodes = concepts.shape[0]
+    for _ in range(num_iterations):
+        num_labels = int(labels.max()) + 1
+        in_hist = torch.bincount(dst * num_labels + labels[src],
+                                 minlength=num_nodes * num_labels).view(num_nodes, num_labels)
+        out_hist = torch.bincount(src * num_labels + labels[dst],
+                                  minlength=num_nodes * num_labels).view(num_nodes, num_labels)
+        _, labels = torch.unique(torch.cat((labels[:, None], in_hist, out_hist), dim=1), dim=0,
+                                 return_inverse=True)
+    return tuple(torch.sort(labels)[0].tolist())
+
+@torch.jit.script
+def _same_label_edges(node_id: torch.Tensor, concepts: torch.Tensor, mask: torch.Tensor,
+                      b: torch.Tensor, src: torch.Tensor, dst: torch.Tensor,
+                      num_base_rows: int, num_base_nodes: int) -> torch.Tensor:
+    """
+    Filter the [num_edges] COO lists down to edges between valid nodes of the same concept and translate them to
+    compact node ids. b may address virtual MC copies of the num_base_rows mask rows; the copies are resolved by
+    index arithmetic so the mask is never materialized more than once. Scripted so the comparison/filter chain
+    fuses instead of materializing each boolean step.
+    """
+    base_row = b % num_base_rows
+    valid = mask[base_row, src] & mask[base_row, dst]
+    base_row, b, src, dst = base_row[valid], b[valid], src[valid], dst[valid]
+    # Compact ids per MC copy continue where the previous copy ended.
+    offset = (b // num_base_rows) * num_base_nodes
+    compact_src = node_id[base_row, src] + offset
+    compact_dst = node_id[base_row, dst] + offset
+    keep = concepts[compact_src] == concepts[compact_dst]
+    return torch.stack((compact_src[keep], compact_dst[keep]))
+
+def _calculate_local_clusters(concepts: torch.Tensor, adj: torch.Tensor, mask: torch.Tensor, is_directed: bool,
+                              num_mc_samples: int = 1) -> torch.Tensor:
+    """
+    The components dispatch in graphutils keeps everything on device for CUDA inputs (cugraph or label
+    propagation), so no dense adjacency ever crosses PCIe; SciPy only handles the CPU case.
+
+    :param concepts: [num_nodes_total] integer array with values in {0, ..., num_concepts - 1}, flat over the
+        valid nodes of all MC samples in the order given by mask
+    :param adj: [batch_size, max_num_nodes, max_num_nodes], shared across all MC samples
+    :param mask: [batch_size', max_num_nodes]; treated as tiled num_mc_samples times along the batch dimension
+        without the caller (or this function) ever allocating the repeated tensor
+    :return: [num_mc_samples * batch_size', max_num_nodes] integer array with values in {0, ..., max_num_clusters}
+        that maps all connected nodes of the same color to one cluster. Crucially, value 0 is reserved for masked
+        nodes and should be removed after scatter.
+    """
+    # Work on the sparse edge list instead of masking the dense [batch_size, max_num_nodes, max_num_nodes]
+    # adjacency: the real edges are O(E) while the dense mask would move O(B * N^2) bytes per call.
+    base_rows, max_num_nodes = mask.shape
+    total_batch_size = base_rows * num_mc_samples
+    # compact node numbering over valid nodes, matching what adj_to_edge_index would produce; MC copies reuse
+    # this base numbering shifted by per-copy offsets instead of a [num_mc_samples * batch_size', N] table
+    node_id = torch.full(mask.shape, -1, dtype=torch.long, device=adj.device)
+    num_base_nodes = int(mask.sum())
+    node_id[mask] = torch.arange(num_base_nodes, device=adj.device)
+    num_nodes = num_base_nodes * num_mc_samples
+    b, src, dst = adj.nonzero(as_tuple=True)
+    edge_tiles = total_batch_size // adj.shape[0]
+    if edge_tiles > 1:
+        # The adjacency is identical for every MC sample, so instead of repeating the dense tensor we tile
+        # the O(E) edge list with per-sample batch offsets.
+        b = (b[None, :] + (torch.arange(edge_tiles, device=adj.device) * adj.shape[0])[:, None]).flatten()
+        src = src.repeat(edge_tiles)
+        dst = dst.repeat(edge_tiles)
+    # keep only edges between valid nodes of the same color (concepts are indexed via the compact node ids,
+    # so no dense [num_mc_samples * batch_size', max_num_nodes] concept tensor is required here)
+    edge_index = _same_label_edges(node_id, concepts, mask, b, src, dst, base_rows, num_base_nodes)
+    # [num_base_nodes] -> [num_nodes] batch vector over all MC copies via one broadcasted add
+    batch = graphutils.batch_from_mask(mask, max_num_nodes)
+    if num_mc_samples > 1:
+        batch = (batch[None, :] + (torch.arange(num_mc_samples, device=adj.device) * base_rows)[:, None]).flatten()
+    return graphutils.components_from_edge_index(edge_index, batch, num_nodes, max_num_nodes,
+                                                 is_directed=is_directed)
+
+def _soft_sample(distances: torch.Tensor, soft_sampling: float, num_mc_samples: int):
     """
-    :param concepts: [batch_size, max_num_nodes] integer array with values in {0, ..., num_concepts - 1}
-    :param adj: [batch_size, max_num_nodes, max_num_nodes]
-    :param mask: [batch_size, max_num_nodes]
-    :return: [batch_size, max_num_nodes] integer array with values in {0, ..., max_num_clusters} that maps all
-        connected nodes of the same color to one cluster. Crucially, value 0 is reserved for masked nodes and should be
-        removed after scatter.
+    Gumbel-max sampling: argmax(logits + Gumbel noise) draws from exactly the categorical distribution
+    softmin(distances / temperature) would define, but in a single pass over the [num_nodes_total, num_concepts]
+    tensor and without constructing a distribution object.
+
+    :param distances: [num_nodes_total, num_concepts]
+    :return:
+        samples: [num_mc_samples, num_nodes_total] sampled concept per node
+        probabilities: [num_mc_samples, num_nodes_total] probability of the drawn concept (detached)
     """
-    # [batch_size, max_num_nodes, max_num_nodes]: masking all edges between nodes of different color
-    adj = torch.where(concepts[:, :, None] == concepts[:, None, :], adj, 0)
-    assignments = graphutils.dense_components(adj, mask, is_directed=is_directed)
-    return assignments
+    # [num_nodes_total, num_concepts]
+    logits = -distances / soft_sampling
+    gumbel = -torch.log(-torch.log(torch.rand((num_mc_samples,) + logits.shape, device=logits.device)))
+    # [num_mc_samples, num_nodes_total]
+    samples = (logits[None] + gumbel).argmax(dim=-1)
+    log_probs = torch.nn.functional.log_softmax(logits, dim=-1)
+    # Note: we only want to use those as weights for the loss but not backpropagate w.r.t. them
+    probabilities = log_probs.expand(num_mc_samples, -1, -1).gather(-1, samples[:, :, None])\
+        .squeeze(-1).exp().detach()
+    return samples, probabilities
+
+if COMPILE_SOFTSAMPLE and hasattr(torch, "compile"):
+    _soft_sample = torch.compile(_soft_sample, mode="reduce-overhead", dynamic=True)
 
 def _generate_assignments(x_mask, adj, mask, is_directed, batch_size, max_num_nodes, soft_sampling: float, training: bool,
                           clustering_loss_weight: float, num_mc_samples: 1, use_global_clusters: bool,
-                          cluster_alg: clustering_wrappers.ClusterAlgWrapper, parallel: bool, transparency: float):
+                          cluster_alg: clustering_wrappers.ClusterAlgWrapper, transparency: float,
+                          use_bf16_distances: bool = False):
     # Note: if we are not soft sampling, the samples should not have an impact here and are instead meant for the outer
     # function which calls this one with different perturbations
     num_mc_samples = num_mc_samples if training and (soft_sampling != 0 or transparency == 0) else 1
-    # Note that pickeling the cluster alg might not be ideal from an efficiency POV
     if not use_global_clusters:
-        # Avoid copies if unnecessary
-        if parallel:
-            cluster_alg = cluster_alg.fit_copy(x_mask)
-        else:
-            cluster_alg.fit(x_mask.detach(), train=training)
+        cluster_alg.fit(x_mask.detach(), train=training)
 
     if (soft_sampling != 0 and training) or clustering_loss_weight != 0:
         # https://ai.stackexchange.com/questions/13776/how-is-reinforce-used-instead-of-backpropagation
-        # [num_nodes_total, num_concepts] (centroids: [num_concepts, embedding_size])
-        distances = torch.cdist(x_mask, cluster_alg.centroids.detach())
+        # [num_nodes_total, num_concepts] (centroids: [num_concepts, embedding_size]). The default cdist heuristic
+        # can fall back to the slow pairwise loop for small embedding sizes, so force the matmul-based path.
+        centroids = cluster_alg.centroids.detach()
+        if use_bf16_distances:
+            # The distances only rank centroids (and weight the loss), so halving their bandwidth is safe;
+            # predict below still sees full-precision inputs.
+            distances = torch.cdist(x_mask.to(torch.bfloat16), centroids.to(torch.bfloat16),
+                                    compute_mode="use_mm_for_euclid_dist").float()
+        else:
+            distances = torch.cdist(x_mask, centroids, compute_mode="use_mm_for_euclid_dist")
     else:
         distances = None
     batch = graphutils.batch_from_mask(mask, max_num_nodes)
     if soft_sampling == 0 or not training:
-        concept_assignments = cluster_alg.predict(x_mask)
+        if distances is not None and not use_bf16_distances:
+            # predict would redo the exact same nearest-centroid search the loss distances already contain
+            concept_assignments = distances.argmin(dim=-1)
+        else:
+            concept_assignments = cluster_alg.predict(x_mask)
         probabilities = None
+        if num_mc_samples > 1:
+            # deterministic assignments are identical for every MC copy
+            concept_assignments = concept_assignments.repeat(num_mc_samples)
+            batch = (batch[None, :] + (torch.arange(num_mc_samples, device=adj.device) * batch_size)[:, None]).flatten()
     else:
-        # [num_nodes_total, num_concepts]
-        assignment_probs = torch.nn.functional.softmin(distances / soft_sampling, dim=-1)
-        distr = Categorical(assignment_probs)
+        # [num_mc_samples, num_nodes_total] each; the sampling chain is kept in its own function so it can be
+        # fused by torch.compile when COMPILE_SOFTSAMPLE is set.
+        samples, probabilities = _soft_sample(distances, soft_sampling, num_mc_samples)
+        probabilities = probabilities.flatten()
         # [num_mc_samples, num_nodes_total] -> [num_mc_samples * num_nodes_total]
-        concept_assignments = distr.sample((num_mc_samples, )).flatten()
-        # [num_nodes_total * num_mc_samples] Note: we only want to use those as weights for the loss but not backpropagate w.r.t. them
-        probabilities = assignment_probs[
-            torch.arange(assignment_probs.shape[0]).repeat(num_mc_samples),
-            concept_assignments].detach()
-        # [num_nodes_total]
-        batch = batch.repeat(num_mc_samples) +\
-                torch.arange(num_mc_samples, device=adj.device).repeat_interleave(assignment_probs.shape[0]) * batch_size
-        # [batch_size * num_samples, max_num_nodes, max_num_nodes] just a repeated version of the original adjacency
-        adj = adj.repeat(num_mc_samples, 1, 1)
+        concept_assignments = samples.flatten()
+        # [num_mc_samples * num_nodes_total] one broadcasted add instead of repeat + repeat_interleave,
+        # which materialized two full-length index tensors before combining them
+        batch = (batch[None, :] + (torch.arange(num_mc_samples, device=adj.device) * batch_size)[:, None]).flatten()
+        # Note that adj is NOT repeated: the cluster computation below shares it across all MC samples
         # [batch_size * num_mc_samples]
         probabilities = scatter(probabilities, batch, reduce="mul")
 
-    # [batch_size * num_mc_samples, max_num_nodes] take only the embeddings of nodes that are not masked (otherwise we would
-    # get different clusters).
+    # [batch_size * (num_mc_samples if soft_sampling else 1), max_num_nodes] assigns each node to a cluster. 0 for masked nodes
+    # The cluster computation consumes the flat concept assignments directly, so no dense round-trip is needed
+    # before it, and it broadcasts the mask over the MC samples itself instead of us allocating mask.repeat.
+    assignments = _calculate_local_clusters(concept_assignments, adj, mask, is_directed,
+                                            num_mc_samples=num_mc_samples)
+    # [batch_size * num_mc_samples, max_num_nodes] densify once at the end for the callers that index with the
+    # per-node concepts (masked slots are filled with -1).
     concept_assignments, mak_temp = to_dense_batch(concept_assignments, batch=batch,
                                                    batch_size=batch_size * num_mc_samples,
                                                    max_num_nodes=max_num_nodes, fill_value=-1)
-    # [batch_size * (num_mc_samples if soft_sampling else 1), max_num_nodes] assigns each node to a cluster. 0 for masked nodes
-    assignments = _calculate_local_clusters_scipy(concept_assignments, adj, mask.repeat(num_mc_samples, 1), is_directed)
 
     return assignments, concept_assignments, distances, probabilities, batch, cluster_alg.centroids.shape[0]
 
@@ -402,12 +597,17 @@ class MonteCarloBlock(PoolBlock):
     TODO: Challenge: how do I even generate a probability distribution over clustered graphs
         -> just sample before the discrete operation (edge generation), I guess
     """
+    # Enables redundant cross-checks (like re-predicting the hard assignments when logging) that should always
+    # agree with the regular code path. Only useful when debugging the clustering itself.
+    debug_sanity_checks = False
+
     def __init__(self, embedding_sizes: List[int], conv_type=DenseGCNConv, activation_function=F.relu,
                  forced_embeddings=None, directed_graphs: bool = True, cluster_alg: str = "KMeans",
                  final_bottleneck: typing.Optional[int] = None, global_clusters: bool = True, soft_sampling: float = 0,
                  clustering_loss_weight: float = 0.0, perturbation: typing.Optional[dict] = None,
                  num_mc_samples: int = 1, transparency: float = 1, state_dict: typing.Optional[dict] = None,
-                 use_centroids_as_embedding: bool = False, **kwargs):
+                 use_centroids_as_embedding: bool = False, use_bf16_distances: bool = False,
+                 compile_pooling: bool = False, **kwargs):
         """
 
         :param embedding_sizes:
@@ -420,6 +620,11 @@ class MonteCarloBlock(PoolBlock):
         :param soft_sampling: If 0, points will always be mapped to the nearest cluster. Otherwise, this will be the
         temperature of a softmax that gives the probability a with which a point will be mapped to each cluster, based
         on the distance from the centroid.
+        :param use_bf16_distances: compute the centroid distances in bfloat16. The centroids are re-fit anyway, so
+        the precision loss is usually irrelevant while halving the bandwidth of the cdist.
+        :param compile_pooling: fuse the pure-tensor pooling step with torch.compile. The reduce-overhead mode
+        also replays it as a CUDA graph on repeated fixed-shape calls, removing the per-step launch overhead of
+        its many small kernels. Off by default as the graph capture can be brittle across torch versions.
         :param kwargs:
         """
         super().__init__(embedding_sizes=embedding_sizes, conv_type=conv_type, activation_function=activation_function,
@@ -437,7 +642,13 @@ class MonteCarloBlock(PoolBlock):
             state_dict = {}
         self.cluster_alg = clustering_wrappers.get_from_name(cluster_alg)(**kwargs, **state_dict)
 
-        self.seen_embeddings = torch.empty((0, self.num_output_features), device=custom_logger.device)
+        # Amortized-O(1) append buffer for the embeddings seen this epoch: a torch.cat per forward pass would
+        # copy the entire accumulated history every batch, which is quadratic in epoch length. end_epoch only
+        # resets the write pointer, so after the first epoch the capacity is stable and no allocations remain.
+        self._seen_buf = torch.empty((1024, self.num_output_features), device=custom_logger.device)
+        self._seen_n = 0
+        # lazily grown arange cache for the index vectors rebuilt every forward
+        self._arange_buf = torch.empty(0, dtype=torch.long, device=custom_logger.device)
         self.global_clusters = global_clusters
         # In the first epoch, we haven't seen the data yet, so we always need to use local clusters. After that,
         # use_global_clusters will be equal to global_clusters
@@ -450,11 +661,9 @@ class MonteCarloBlock(PoolBlock):
         self.transparency = transparency
         self.last_num_clusters = None
         self.use_centroids_as_embedding = use_centroids_as_embedding
-        if use_centroids_as_embedding and\
-                (self.num_mc_samples == 1 or self.perturbation is None or self.transparency != 1) and\
-                custom_logger.cpu_workers != 0:
-            raise NotImplementedError("Centroids as embeddings are not implemented for parallel workers!")
-
+        self.use_bf16_distances = use_bf16_distances
+        self._pool_fn = torch.compile(self._pool, dynamic=True, mode="reduce-overhead")\
+            if compile_pooling and hasattr(torch, "compile") else self._pool
         self.num_mc_samples = num_mc_samples
         if num_mc_samples > 1 and soft_sampling == 0 and perturbation is None:
             raise ValueError(f"Multiple monte carlo samples ({num_mc_samples} given) only make sense when sampling is "
@@ -468,22 +677,44 @@ class MonteCarloBlock(PoolBlock):
             self.final_bottleneck = torch.nn.Linear(embedding_sizes[-1], final_bottleneck)
         else:
             self.final_bottleneck = None
-        if self.perturbation is not None and self.num_mc_samples != 1 and self.transparency != 1 and custom_logger.cpu_workers > 0:
-            self.pool = ProcessPoolExecutor(max_workers=custom_logger.cpu_workers)
 
     def preprocess(self, x: torch.Tensor, adj: torch.Tensor, mask=None, edge_weights=None):
         if self.forced_embeddings is not None:
-            x = torch.ones(x.shape[:-1] + (self.num_output_features,), device=x.device) * self.forced_embeddings
+            x = self._forced(x, self.num_output_features)
         else:
-            for conv in self.embedding_convs:
-                x = self.activation_function(conv(x, adj, mask))
+            x = self._embed_fn(x, adj, mask)
         if self.global_clusters and self.training:
             # Only adding training data makes it impossible to generalize to new concepts during test but that's kinda
             # unlikely anyway. Alternatively one could append test embeddings but then one would need to undo those
             # changes before starting the next round of training to avoid the test data influencing the training
-            self.seen_embeddings = torch.cat((self.seen_embeddings, x[mask].detach()), dim=0)
+            self._append_seen(x[mask].detach())
         return x
 
+    @property
+    def seen_embeddings(self):
+        return self._seen_buf[:self._seen_n]
+
+    def _append_seen(self, new: torch.Tensor):
+        n = new.shape[0]
+        if self._seen_n + n > self._seen_buf.shape[0]:
+            # double the capacity so the single copy here amortizes over all appends
+            grown = torch.empty((max(2 * self._seen_buf.shape[0], self._seen_n + n), self.num_output_features),
+                                device=self._seen_buf.device)
+            grown[:self._seen_n] = self._seen_buf[:self._seen_n]
+            self._seen_buf = grown
+        self._seen_buf[self._seen_n:self._seen_n + n] = new
+        self._seen_n += n
+
+    def _arange(self, n: int) -> torch.Tensor:
+        """
+        Prefix of a cached arange, grown geometrically: saves an allocation and kernel launch for the index
+        vectors needed on every forward pass.
+        """
+        if self._arange_buf.shape[0] < n:
+            self._arange_buf = torch.arange(max(n, 2 * self._arange_buf.shape[0]), dtype=torch.long,
+                                            device=custom_logger.device)
+        return self._arange_buf[:n]
+
     def perturb(self, x: torch.Tensor):
         return self.perturbation(x) if self.train else x
 
@@ -493,69 +724,122 @@ class MonteCarloBlock(PoolBlock):
                                        batch_size=x.shape[0], max_num_nodes=x.shape[1], soft_sampling=self.soft_sampling,
                                        training=self.training, clustering_loss_weight=self.clustering_loss_weight,
                                        num_mc_samples=self.num_mc_samples, use_global_clusters=self.use_global_clusters,
-                                       cluster_alg=self.cluster_alg, transparency=self.transparency)
+                                       cluster_alg=self.cluster_alg, transparency=self.transparency,
+                                       use_bf16_distances=self.use_bf16_distances)
         batch_size, max_num_nodes = x.shape[:2]
 
         if self.num_mc_samples == 1 or self.perturbation is None or self.transparency != 1:
             # TODO I don't scale up the mask for the diff calls
             assignments, concept_assignments, distances, probabilities, batch, self.last_num_clusters =\
-                generate_assignments(x[mask].detach(), parallel=False)
+                generate_assignments(x[mask].detach())
         else:
             distances = probabilities = None  # We are using perturbation, so definitely no soft sampling
-            assignments = torch.empty(batch_size * num_mc_samples, max_num_nodes, device=x.device, dtype=torch.long)
-            concept_assignments = torch.empty(batch_size * num_mc_samples, max_num_nodes, device=x.device, dtype=torch.long)
-            # [num_nodes_total (for all samples together)]
-            batch = torch.empty((0, ), device=x.device, dtype=torch.long)
-            if custom_logger.cpu_workers == 0:
+            if self.use_global_clusters:
+                # Every MC sample is an independent batch element for the assignment computation and the
+                # perturbation can draw all samples in one call, so a single batched call replaces the
+                # Python loop that relaunched the same kernels once per sample.
+                assignments, concept_assignments, _, _, batch, self.last_num_clusters = _generate_assignments(
+                    self.perturbation(x[mask], num_mc_samples).detach(), adj=adj,
+                    mask=mask.repeat(num_mc_samples, 1), is_directed=self.directed_graphs,
+                    batch_size=batch_size * num_mc_samples, max_num_nodes=max_num_nodes,
+                    soft_sampling=self.soft_sampling, training=self.training,
+                    clustering_loss_weight=self.clustering_loss_weight, num_mc_samples=1,
+                    use_global_clusters=self.use_global_clusters, cluster_alg=self.cluster_alg,
+                    transparency=self.transparency, use_bf16_distances=self.use_bf16_distances)
+            else:
+                assignments = torch.empty(batch_size * num_mc_samples, max_num_nodes, device=x.device, dtype=torch.long)
+                concept_assignments = torch.empty(batch_size * num_mc_samples, max_num_nodes, device=x.device, dtype=torch.long)
+                # [num_nodes_total (for all samples together)] collected once at the end: growing a tensor with
+                # torch.cat inside the loop would copy the accumulated prefix every iteration
+                batch_parts = []
+                # gathered once: the masked node features are identical for every sample, only the noise differs
+                x_masked = x[mask]
+                # local clusters need a separate fit per perturbed sample, so the loop remains here
                 for sample in range(num_mc_samples):
                     # Note that adj is only modified for soft sampling. batch_s is of size [batch_size]
                     ass_s, conc_ass_s, dist_s, prob_s, batch_s, self.last_num_clusters =\
-                        generate_assignments(self.perturb(x[mask]).detach(), parallel=False)
+                        generate_assignments(self.perturb(x_masked).detach())
                     assignments[sample * batch_size:(sample + 1) * batch_size] = ass_s
                     concept_assignments[sample * batch_size:(sample + 1) * batch_size] = conc_ass_s
-                    batch = torch.cat((batch, batch_s), dim=0)
-            else:
-                generate_assignments = partial(generate_assignments, parallel=True)
-                try:
-                    res = self.pool.map(generate_assignments, [self.perturb(x[mask].detach()) for _ in range(num_mc_samples)])
-                    for sample, (ass_s, conc_ass_s, dist_s, prob_s, batch_s, self.last_num_clusters) in enumerate(res):
-                        assignments[sample * batch_size:(sample + 1) * batch_size] = ass_s
-                        concept_assignments[sample * batch_size:(sample + 1) * batch_size] = conc_ass_s
-                        batch = torch.cat((batch, batch_s), dim=0)
-                except:
-                    self.pool.shutdown()
-                    exit()
-        adj = adj.repeat(num_mc_samples, 1, 1)
+                    batch_parts.append(batch_s)
+                batch = torch.cat(batch_parts, dim=0)
 
+        x_new, adj_new, mask_new = self._pool_fn(x, adj, assignments, concept_assignments)
+        if self.clustering_loss_weight == 0:
+            clustering_loss = 0
+        else:
+            # amin instead of min: we never use the argmin indices here, so no need to compute and write them
+            clustering_loss = self.clustering_loss_weight * torch.linalg.vector_norm(distances.amin(dim=-1))
+            # Cap clustering loss at 10 to avoid numerical instability. The branchless form divides by
+            # max(loss / 10, 1), identical to the old if-branch but without forcing the scalar to the host
+            # (the Python comparison synchronized the device every forward).
+            clustering_loss = clustering_loss * (10.0 / clustering_loss.detach().clamp_min(10.0))
+        return x_new, adj_new, None, probabilities, clustering_loss, concept_assignments, assignments, x, mask_new
 
+    def _pool(self, x: torch.Tensor, adj: torch.Tensor, assignments: torch.Tensor,
+              concept_assignments: torch.Tensor):
+        """
+        Pure-tensor pooling of node features and adjacency by cluster assignment. Kept free of clustering and
+        SciPy calls so it can be fused by torch.compile when compile_pooling is set.
+        """
+        total_rows = assignments.shape[0]
+        # number of output slots per batch element, including the placeholder cluster 0 for masked nodes
+        num_cluster_slots = int(torch.max(assignments)) + 1
+        # [total_rows * max_num_nodes] flat per-row offset index: index_add_ over the flattened batch avoids
+        # materializing the broadcast [total_rows, max_num_nodes, num_features] index the generic scatter needs
+        idx_flat = (assignments + self._arange(total_rows)[:, None] * num_cluster_slots).reshape(-1)
         if self.use_centroids_as_embedding:
-            scattered_x = self.cluster_alg.centroids[concept_assignments].repeat(num_mc_samples, 1, 1)
-            # [batch_size * num_mc_samples, max_num_clusters] (repeat: [batch_size * num_mc_samples, num_nodes_max, num_features])
-            # definitely not the most efficient way, as reduce is useless, just need inverse
-            x_new = scatter(scattered_x, assignments[:, :, None], reduce="mean", dim=-2)[:, 1:, :]
+            centroids = self.cluster_alg.centroids
+            num_concepts = centroids.shape[0]
+            # Joint histogram over (flat output slot, concept): the cluster sums then reduce to one small
+            # [total_rows * slots, num_concepts] @ [num_concepts, num_features] matmul instead of gathering a
+            # full [total_rows, max_num_nodes, num_features] tensor of centroid copies and mean-reducing it.
+            # The modulo maps the -1 fill of masked slots onto the last centroid exactly like the old gather;
+            # those nodes only land in the dropped placeholder cluster 0 anyway.
+            concepts_flat = concept_assignments.reshape(-1) % num_concepts
+            hist = torch.bincount(idx_flat * num_concepts + concepts_flat,
+                                  minlength=total_rows * num_cluster_slots * num_concepts)
+            hist = hist.view(total_rows * num_cluster_slots, num_concepts).to(centroids.dtype)
+            sums = hist @ centroids
+            counts = hist.sum(dim=-1).clamp_min_(1)
         else:
-            # [batch_size * num_mc_samples, max_num_clusters] (repeat: [batch_size * num_mc_samples, num_nodes_max, num_features])
-            x_new = scatter(x.repeat(num_mc_samples, 1, 1), assignments[:, :, None], reduce="mean", dim=-2)[:, 1:, :]
+            # x is identical for every MC copy, so instead of materializing x.repeat at [rows, N, F] the same
+            # [B * N, F] source is added into the flat sums buffer once per copy (the offsets in idx_flat keep
+            # the copies in disjoint output slots)
+            x_flat = x.reshape(x.shape[0] * x.shape[1], -1)
+            sums = x_flat.new_zeros((total_rows * num_cluster_slots, x_flat.shape[1]))
+            idx_per_sample = idx_flat.view(-1, x_flat.shape[0])
+            for s in range(idx_per_sample.shape[0]):
+                sums.index_add_(0, idx_per_sample[s], x_flat)
+            counts = torch.bincount(idx_flat, minlength=total_rows * num_cluster_slots).clamp_min_(1)
+        # [batch_size * num_mc_samples, max_num_clusters, num_features] with cluster 0 (masked nodes) removed
+        x_new = (sums / counts[:, None]).view(total_rows, num_cluster_slots, -1)[:, 1:, :]
         if self.final_bottleneck is not None:
             # Because both transformations are linear, this should be equivalent to applying it before pooling
             x_new = self.final_bottleneck(x_new)
-        # [batch_size * num_mc_samples, max_num_nodes, max_num_clusters]: for each node: all clusters it points to (with index 0 (masked nodes) removed)
-        adj_new = scatter(adj, assignments[:, :, None], reduce="max", dim=-2)[:, 1:, :]
-        # [batch_size * num_mc_samples, max_num_clusters, max_num_clusters]: for each cluster: all clusters it points to  (with index 0 (masked nodes) removed)
-        adj_new = scatter(adj_new, assignments[:, None, :], reduce="max", dim=-1)[:, :, 1:]
+        # [batch_size * num_mc_samples, max_num_clusters, max_num_clusters] with index 0 (masked nodes) removed
+        # on both axes. One amax over the nonzero edges only: edge (i, j) lands directly in cell (a_i, a_j) of
+        # its sample's output, so the zero cells of the dense adjacency are never indexed and the MC copies only
+        # tile the O(E) edge list instead of any dense tensor. The amax into a zero buffer matches the old dense
+        # scatter semantics for the non-negative adjacency.
+        samples_per_graph = total_rows // adj.shape[0]
+        b, src, dst = adj.nonzero(as_tuple=True)
+        vals = adj[b, src, dst]
+        if samples_per_graph > 1:
+            b = (b[None, :] + (torch.arange(samples_per_graph, device=adj.device) * adj.shape[0])[:, None]).flatten()
+            src = src.repeat(samples_per_graph)
+            dst = dst.repeat(samples_per_graph)
+            vals = vals.repeat(samples_per_graph)
+        pair_idx = (b * num_cluster_slots + assignments[b, src]) * num_cluster_slots + assignments[b, dst]
+        adj_new = vals.new_zeros(total_rows * num_cluster_slots * num_cluster_slots)\
+            .scatter_reduce_(0, pair_idx, vals, reduce="amax")\
+            .view(total_rows, num_cluster_slots, num_cluster_slots)[:, 1:, 1:]
 
         # [batch_size * num_mc_samples] Note that this gives the number of clusters, not the index because 0 is the placeholder for masked nodes
         num_clusters, _ = torch.max(assignments, dim=-1)
         # [batch_size * num_mc_samples, max_num_clusters]: True iff cluster/new node index is valid / less than the number of clusters in that batch element
-        mask_new = torch.arange(x_new.shape[-2], device=custom_logger.device)[None, :] < num_clusters[:, None]
-        if self.clustering_loss_weight == 0:
-            clustering_loss = 0
-        else:
-            clustering_loss = self.clustering_loss_weight * torch.linalg.vector_norm(torch.min(distances, dim=-1)[0])
-            if clustering_loss >= 10:
-                # Cap clustering loss at 10 to avoid numerical instability
-                clustering_loss /= (clustering_loss.detach() / 10)
-        return x_new, adj_new, None, probabilities, clustering_loss, concept_assignments, assignments, x, mask_new
+        mask_new = self._arange(x_new.shape[-2])[None, :] < num_clusters[:, None]
+        return x_new, adj_new, mask_new
 
     def forward(self, x: torch.Tensor, adj: torch.Tensor, mask=None, edge_weights=None):
         assert self.transparency == 1
@@ -571,11 +855,13 @@ class MonteCarloBlock(PoolBlock):
         # clusters
         TEMPERATURE = 0.1  # softmax temperature that makes clearer which node is assigned to which cluster
         SAMPLES_PER_CONCEPT = 3
-        node_table = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_color", "label", "activations"])
-        edge_table = wandb.Table(["graph", "pool_step", "source", "target"])
-        concept_node_tables = {}
-        concept_edge_tables = {}
-        concept_purity_table = wandb.Table(["pool_step", "concept", "top-graph", "occurrences"])
+        # rows are accumulated in Python lists and converted in bulk: per-cell .item() calls would trigger one
+        # device sync each and dominate the logging time for large graphs
+        node_rows = []
+        edge_rows = []
+        concept_node_rows = {}
+        concept_edge_rows = {}
+        concept_purity_rows = []
         device = custom_logger.device
         with torch.no_grad():
             data = data.clone().detach().to(device)
@@ -590,10 +876,12 @@ class MonteCarloBlock(PoolBlock):
             centroids = [torch.eye(data.x.shape[-1], device=custom_logger.device)] + \
                         [pb.cluster_alg.centroids.detach() if hasattr(pb, "cluster_alg") else None for pb in model.graph_network.pool_blocks]
             # for each pool block [num_nodes_in_total, num_centroids] with the distance of each node embedding (after GNN) to each centroid
-            centroid_distances = [torch.cdist(pool_activations[pool_step + 1][masks[pool_step]], centroids[pool_step + 1])
+            centroid_distances = [_pairwise_dist(pool_activations[pool_step + 1][masks[pool_step]], centroids[pool_step + 1])
                                   for pool_step in range(len(pool_assignments))]
-            # for each pool block [num_nodes_in_total] with the concept that is assigned to each input node to the pool block
-            initial_concepts = [torch.argmin(torch.cdist(input_embeddings[pool_step][masks[pool_step]], centroids[pool_step]), dim=-1)
+            # for each pool block [num_nodes_in_total] with the concept that is assigned to each input node to the pool
+            # block. Squared distances suffice for the argmin.
+            initial_concepts = [torch.argmin(_pairwise_dist(input_embeddings[pool_step][masks[pool_step]],
+                                                            centroids[pool_step], squared=True), dim=-1)
                                 for pool_step in range(len(pool_assignments))]
 
             ############################## Log distance to centroid distribution #########
@@ -602,8 +890,7 @@ class MonteCarloBlock(PoolBlock):
                 # overall index and all others to -1
                 dense_to_sparse_maps = torch.full(masks[pool_step].shape, -1, dtype=torch.long,
                                                   device=custom_logger.device)
-                dense_to_sparse_maps[masks[pool_step]] = torch.arange(dense_to_sparse_maps[masks[pool_step]].shape[0],
-                                                                      device=custom_logger.device)
+                dense_to_sparse_maps[masks[pool_step]] = self._arange(int(masks[pool_step].sum()))
 
 
                 pool_block = model.graph_network.pool_blocks[pool_step]
@@ -614,24 +901,38 @@ class MonteCarloBlock(PoolBlock):
                 medians, _ = torch.median(sorted_distances, dim=0)
                 mins, _ = torch.min(sorted_distances, dim=0)
                 maxs, _ = torch.max(sorted_distances, dim=0)
-                dist_table = wandb.Table(["sortindex", "mean", "std", "median", "min", "max"])
-                for i in range(stds.shape[0]):
-                    dist_table.add_data(i, means[i].item(), stds[i].item(), medians[i].item(), mins[i].item(),
-                                        maxs[i].item())
-                log({f"centroid_distances_{pool_step}": dist_table}, step=epoch)
+                dist_rows = [list(row) for row in zip(range(stds.shape[0]), means.tolist(), stds.tolist(),
+                                                      medians.tolist(), mins.tolist(), maxs.tolist())]
+                log({f"centroid_distances_{pool_step}": wandb.Table(["sortindex", "mean", "std", "median", "min",
+                                                                     "max"], data=dist_rows)}, step=epoch)
 
                 ############################## Print Probability Distributions #########
                 if temperature != 0:
-                    # Note: the hard_assignments here are just a sanity check and should always agree. They can be
-                    # removed for efficiency
-                    hard_assignments = pool_block.cluster_alg.predict(pool_activations[pool_step + 1][masks[pool_step]])
-                    max_probs, arg_max = torch.max(torch.nn.functional.softmin(centroid_distances[pool_step] / temperature, dim=-1), dim=-1)
-                    print(f"\nProbability of most likely concept in pooling step {pool_step}: "
-                          f"{100 * torch.mean(max_probs):.2f}%+-{100*torch.std(max_probs):.2f} with "
-                          f"{100 * torch.sum(hard_assignments == arg_max) / arg_max.shape[0]:.2f}% of the soft maxima "
-                          f"agreeing with the hard assignment")
+                    # the probabilities fold the temperature scale into the softmax input as a cheap multiply
+                    max_probs = torch.softmax(-centroid_distances[pool_step] * (1.0 / temperature), dim=-1).max(dim=-1)[0]
+                    message = f"\nProbability of most likely concept in pooling step {pool_step}: " \
+                              f"{100 * torch.mean(max_probs):.2f}%+-{100 * torch.std(max_probs):.2f}"
+                    if self.debug_sanity_checks:
+                        # the hard_assignments here are just a sanity check and should always agree with the soft
+                        # maxima. The argmax of the softmin is just the argmin of the distances, no softmax needed.
+                        hard_assignments = pool_block.cluster_alg.predict(pool_activations[pool_step + 1][masks[pool_step]])
+                        arg_max = centroid_distances[pool_step].argmin(dim=-1)
+                        message += f" with {100 * torch.sum(hard_assignments == arg_max) / arg_max.shape[0]:.2f}% " \
+                                   f"of the soft maxima agreeing with the hard assignment"
+                    print(message)
 
                 ############################## Log Graphs ##############################
+                # One batched edge extraction for all logged graphs instead of an adj_to_edge_index call (and
+                # its kernel launches) per graph. The cumsum renumbers the unmasked nodes of each graph
+                # compactly, matching the node row indices below.
+                masks_to_log = masks[pool_step][:num_graphs_to_log]
+                adjs_to_log = adjs[pool_step][:num_graphs_to_log] * \
+                    torch.logical_and(masks_to_log[:, :, None], masks_to_log[:, None, :])
+                compact_index = torch.cumsum(masks_to_log, dim=1) - 1
+                edge_graph, edge_source, edge_target = adjs_to_log.nonzero(as_tuple=True)
+                edge_rows += [[g, pool_step, s, t] for g, s, t in
+                              torch.stack((edge_graph, compact_index[edge_graph, edge_source],
+                                           compact_index[edge_graph, edge_target]), dim=1).cpu().tolist()]
                 for graph_i in range(num_graphs_to_log):
                     # Calculate concept assignment colors
                     # [num_nodes] (with batch dimension and masked nodes removed)
@@ -642,25 +943,24 @@ class MonteCarloBlock(PoolBlock):
 
                     # Calculate feature colors
                     # [num_nodes_in_neighbourhood, num_concepts] where (i, j) gives difference between node i and concept j
-                    feature_colors = torch.cdist(input_embeddings[pool_step][graph_i, masks[pool_step][graph_i]],
-                                                 centroids[pool_step])
-                    ColorUtils.ensure_min_rgb_feature_colors(feature_colors.shape[1])
-                    feature_colors = torch.sum(torch.nn.functional.softmin(feature_colors / TEMPERATURE, dim=1)[:, :, None].cpu() *
-                                               ColorUtils.rgb_feature_colors[None, :feature_colors.shape[1], :], dim=1)
-                    feature_colors = torch.round(feature_colors).to(int)
-
-                    for i, i_old in enumerate(masks[pool_step][graph_i].nonzero().squeeze(1)):
-                        node_table.add_data(graph_i, pool_step, i, feature_colors[i, 0].item(),
-                                            feature_colors[i, 1].item(), feature_colors[i, 2].item(),
-                                            ColorUtils.rgb2hex_tensor(concept_colors[i, :]),
-                                            f"Cluster {assignment[i]}",
-                                            ", ".join([f"{m.item():.2f}" for m in
-                                                       pool_activations[pool_step][graph_i, i_old, :].cpu()]))
-
-                    edge_index, _, _ = adj_to_edge_index(adjs[pool_step][graph_i:graph_i+1, :, :],
-                                                         masks[pool_step][graph_i:graph_i+1])
-                    for i in range(edge_index.shape[1]):
-                        edge_table.add_data(graph_i, pool_step, edge_index[0, i].item(), edge_index[1, i].item())
+                    distances = _pairwise_dist(input_embeddings[pool_step][graph_i, masks[pool_step][graph_i]],
+                                               centroids[pool_step])
+                    ColorUtils.ensure_min_rgb_feature_colors(distances.shape[1])
+                    # blending the concept colors is a [num_nodes, num_concepts] @ [num_concepts, 3] matmul;
+                    # the broadcast-and-sum it replaces materialized a [num_nodes, num_concepts, 3] intermediate
+                    probs = torch.nn.functional.softmin(distances * (1.0 / TEMPERATURE), dim=1).cpu()
+                    feature_colors = torch.round(probs @ ColorUtils.rgb_feature_colors[:distances.shape[1], :]).to(int)
+
+                    feature_colors_list = feature_colors.tolist()
+                    assignment_list = assignment.tolist()
+                    activations_list = pool_activations[pool_step][graph_i].cpu().tolist()
+                    # one tensor-to-host conversion for all hex strings; rgb2hex_tensor would .item() each channel
+                    concept_hex = ColorUtils.rgb2hex_batch(concept_colors)
+                    node_rows += [[graph_i, pool_step, i, feature_colors_list[i][0], feature_colors_list[i][1],
+                                   feature_colors_list[i][2], concept_hex[i],
+                                   f"Cluster {assignment_list[i]}",
+                                   ", ".join([f"{m:.2f}" for m in activations_list[i_old]])]
+                                  for i, i_old in enumerate(masks[pool_step][graph_i].nonzero().squeeze(1).tolist())]
 
                 assignment = pool_assignments[pool_step]
 
@@ -668,88 +968,122 @@ class MonteCarloBlock(PoolBlock):
                 # This is not ideal as we only sample concepts from the same (first) batch. But we could increase it's size
                 # [batch_size, max_num_nodes] True iff. the connected component of a node has already been explored
                 checked_mask = torch.zeros(*masks[pool_step].shape, dtype=torch.bool)
-                for concept in torch.unique(assignment).tolist():
+                # Neither the per-sample edge index, its same-assignment filter nor the node counts depend on the
+                # concept currently explored, so they are computed once here instead of per unchecked node below.
+                nodes_per_graph = masks[pool_step].sum(dim=1).tolist()
+                filtered_edge_indices = {}
+                component_labels = {}
+                # Group the unmasked (batch_index, node_index) pairs by concept with a single sort, so the loop
+                # below only slices its segment instead of re-scanning the full [batch_size, max_num_nodes]
+                # tensor once per concept
+                valid_nodes = masks[pool_step].nonzero()
+                assignment_flat = assignment[masks[pool_step]]
+                # one host transfer for the whole grouped list: iterating the tensor below would convert each
+                # (batch_index, node_index) pair to Python ints individually
+                grouped_nodes = valid_nodes[torch.argsort(assignment_flat)].tolist()
+                unique_concepts, concept_counts = torch.unique(assignment_flat, return_counts=True)
+                segment_start = 0
+                for concept, concept_count in zip(unique_concepts.tolist(), concept_counts.tolist()):
                     ####################### Log Example Concept Graphs #######################
-                    if concept not in concept_node_tables:
-                        concept_node_tables[concept] = wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b",
-                                                                    "border_color", "label", "activations"])
-                        concept_edge_tables[concept] = wandb.Table(["graph", "pool_step", "source", "target"])
-                    concept_node_table, concept_edge_table = concept_node_tables[concept], concept_edge_tables[concept]
+                    if concept not in concept_node_rows:
+                        concept_node_rows[concept] = []
+                        concept_edge_rows[concept] = []
 
-                    # [num_nodes_with_concept_total, 2] with all pairs of (batch_index, node_index) of nodes that are
-                    # not masked and are classified to a certain example
-                    example_nodes = (torch.logical_and(masks[pool_step], assignment == concept)).nonzero()
+                    # all (batch_index, node_index) pairs of nodes that are not masked and are classified to a
+                    # certain example
+                    example_nodes = grouped_nodes[segment_start:segment_start + concept_count]
+                    segment_start += concept_count
 
                     # ################################ Log Concept Purity and Top Subgraphs ################################
                     # TODO this should ideally be somewhere where I pass over the whole graph
                     # to reduce the number of isomorphism tests, we first build up a WL hash table. The entry at each
                     # key contains a list of tuples of networkx graphs and the number of isomorphic graphs
                     buckets = {}
-                    for sample, node in example_nodes:
-                        if checked_mask[sample, node]:
+                    for sample_i, node_i in example_nodes:
+                        if checked_mask[sample_i, node_i]:
                             continue
-                        edge_index_prev, _, _ = adj_to_edge_index(adjs[pool_step][sample])
-                        edge_index_prev = edge_index_prev[:, assignment[sample, edge_index_prev[0, :]] == assignment[
-                            sample, edge_index_prev[1, :]]]
-                        nodes_in_cur_graph = torch.sum(masks[pool_step][sample]).item()
-                        subset, edge_index, mapping, _ = k_hop_subgraph(node.item(), nodes_in_cur_graph,
-                                                                        edge_index_prev,
-                                                                        relabel_nodes=True,
-                                                                        num_nodes=nodes_in_cur_graph)
-                        checked_mask[sample, mapping] = True
-
-                        G = to_networkx(Data(concept=initial_concepts[pool_step][dense_to_sparse_maps[sample, subset]],
-                                             edge_index=edge_index, num_nodes=subset.shape[0]),
-                                        to_undirected=not self.directed_graphs,
-                                        node_attrs=["concept"])
-                        key = nx.algorithms.graph_hashing.weisfeiler_lehman_graph_hash(G, node_attr="concept")
-
+                        if sample_i not in filtered_edge_indices:
+                            edge_index_prev, _, _ = adj_to_edge_index(adjs[pool_step][sample_i])
+                            filtered_edge_indices[sample_i] =\
+                                edge_index_prev[:, assignment[sample_i, edge_index_prev[0, :]] ==
+                                                assignment[sample_i, edge_index_prev[1, :]]]
+                            # one components pass yields every same-assignment subgraph of the sample at once
+                            # instead of re-running a full-depth BFS (k_hop_subgraph) from each node
+                            _, component_labels[sample_i] = graphutils.sparse_components(
+                                filtered_edge_indices[sample_i], nodes_per_graph[sample_i],
+                                is_directed=self.directed_graphs)
+                        edge_index_prev = filtered_edge_indices[sample_i]
+                        labels = component_labels[sample_i]
+                        component = labels[node_i]
+                        # [num_nodes_in_component] original node indices of the component, matching what
+                        # k_hop_subgraph with relabeling returned before
+                        subset = (labels == component).nonzero().squeeze(1)
+                        node_map = torch.full((nodes_per_graph[sample_i],), -1, dtype=torch.long,
+                                              device=subset.device)
+                        node_map[subset] = torch.arange(subset.shape[0], device=subset.device)
+                        edge_index = node_map[edge_index_prev[:, labels[edge_index_prev[0]] == component]]
+                        checked_mask[sample_i, subset] = True
+
+                        node_concepts = initial_concepts[pool_step][dense_to_sparse_maps[sample_i, subset]]
+                        # The exact is_isomorphic tests within each WL bucket dominated this loop. The tensor
+                        # WL refinement combined with the sorted multisets of concept-labelled edges and nodes
+                        # is an exact signature for the tiny concept subgraphs occurring here, so it serves as
+                        # the bucket key directly and each bucket just keeps one representative and a count.
+                        # No networkx graph is built anymore; representatives are logged straight from the
+                        # (concepts, edge index) tensors below.
+                        key = (_wl_signature(node_concepts, edge_index),
+                               tuple(sorted(zip(node_concepts[edge_index[0]].tolist(),
+                                                node_concepts[edge_index[1]].tolist()))),
+                               tuple(sorted(node_concepts.tolist())))
                         if key in buckets:
-                            for other_graph, occurrences in buckets[key].items():
-                                # iso.generic_node_match("concept", None, list_close)
-                                if nx.is_isomorphic(other_graph, G, node_match=iso.categorical_node_match("concept",
-                                                                                                          None)):
-                                    buckets[key][other_graph] = occurrences + 1
-                                    break
-                            else:
-                                buckets[key][G] = 1
+                            buckets[key][1] += 1
                         else:
-                            buckets[key] = {G: 1}
+                            buckets[key] = [(node_concepts, edge_index), 1]
 
-                    occurrences = []
-                    for bucket in buckets.values():
-                        occurrences += bucket.items()
+                    occurrences = list(buckets.values())
 
                     samples_seen = 0
-                    for top_k, (subgraph, occ) in enumerate(sorted(occurrences, key=lambda k: k[1], reverse=True)):
-                        concept_purity_table.add_data(pool_step, concept, top_k, occ)
+                    for top_k, ((rep_concepts, rep_edge_index), occ) in \
+                            enumerate(sorted(occurrences, key=lambda k: k[1], reverse=True)):
+                        concept_purity_rows.append([pool_step, concept, top_k, occ])
                         if samples_seen < SAMPLES_PER_CONCEPT:
                             ################## Log Top Subgraphs in Concept #################
-                            for i, node_concept in nx.get_node_attributes(subgraph, "concept").items():
-                                ColorUtils.ensure_min_rgb_colors(node_concept)
-                                concept_node_table.add_data(samples_seen, pool_step, i, ColorUtils.rgb_colors[node_concept][0],
-                                                            ColorUtils.rgb_colors[node_concept][1],
-                                                            ColorUtils.rgb_colors[node_concept][2],
-                                                            "#FFF", # as all nodes are mapped to the same concept, it doesn't matter which one was selected"#F00" if subset[i] == node.item() else "#FFF",
-                                                            # This gives insights how likely it would be that the node would have been mapped to another centroid
-                                                            # BUT would require either storing the "subset" mapping or the lables directly in the graph. Do if necessary.
-                                                            "", # "Distances: " + ", ".join([f"{m.item():.2f}" for m in centroid_distances[pool_step][i, :].cpu()]),
-                                                            "")
-                            for (from_node, to_node) in subgraph.edges:
-                                concept_edge_table.add_data(samples_seen, pool_step, from_node, to_node)
+                            # one batched color lookup for the whole subgraph instead of scalar indexing (and an
+                            # ensure_min_rgb_colors call) per node
+                            concept_ids = rep_concepts.cpu()
+                            ColorUtils.ensure_min_rgb_colors(int(concept_ids.max()) + 1)
+                            node_colors = ColorUtils.rgb_colors[concept_ids].tolist()
+                            # as all nodes are mapped to the same concept, it doesn't matter which one was
+                            # selected for the border color. The label could give insights how likely it
+                            # would be that the node would have been mapped to another centroid BUT would
+                            # require either storing the "subset" mapping or the labels directly in the
+                            # graph. Do if necessary.
+                            concept_node_rows[concept] += [[samples_seen, pool_step, i, r, g, b, "#FFF", "", ""]
+                                                           for i, (r, g, b) in enumerate(node_colors)]
+                            edges = rep_edge_index.t().tolist()
+                            if not self.directed_graphs:
+                                # the edge index holds both directions, log each undirected edge only once
+                                edges = [e for e in edges if e[0] <= e[1]]
+                            concept_edge_rows[concept] += [[samples_seen, pool_step, from_node, to_node]
+                                                           for (from_node, to_node) in edges]
                             samples_seen += 1
 
-        log({f"concept_purity_table": concept_purity_table}, step=epoch)
+        log({f"concept_purity_table": wandb.Table(["pool_step", "concept", "top-graph", "occurrences"],
+                                                  data=concept_purity_rows)}, step=epoch)
 
-        for concept in concept_node_tables.keys():
+        for concept in concept_node_rows.keys():
             log({
-                f"concept_node_table_{concept}": concept_node_tables[concept],
-                f"concept_edge_table_{concept}": concept_edge_tables[concept]
+                f"concept_node_table_{concept}": wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b",
+                                                              "border_color", "label", "activations"],
+                                                             data=concept_node_rows[concept]),
+                f"concept_edge_table_{concept}": wandb.Table(["graph", "pool_step", "source", "target"],
+                                                             data=concept_edge_rows[concept])
             }, step=epoch)
         log(dict(
             # graphs_table=graphs_table
-            node_table=node_table,
-            edge_table=edge_table
+            node_table=wandb.Table(["graph", "pool_step", "node_index", "r", "g", "b", "border_color", "label",
+                                    "activations"], data=node_rows),
+            edge_table=wandb.Table(["graph", "pool_step", "source", "target"], data=edge_rows)
         ), step=epoch)
 
     def end_epoch(self):
@@ -757,7 +1091,8 @@ class MonteCarloBlock(PoolBlock):
             return
         self.use_global_clusters = True
         self.cluster_alg.fit(self.seen_embeddings.detach(), train=True)
-        self.seen_embeddings = torch.empty((0, self.num_output_features), device=custom_logger.device)
+        # keep the capacity for the next epoch, just reset the write pointer
+        self._seen_n = 0
 
     @PoolBlock.output_dim.getter
     def output_dim(self):
@@ -766,13 +1101,15 @@ class MonteCarloBlock(PoolBlock):
 
 __all_dense__ = [DenseNoPoolBlock, DiffPoolBlock, MonteCarloBlock]
 __all_sparse__ = [ASAPBlock, SparseNoPoolBlock]
+_dense_by_name = {b.__name__[:-len("Block")]: b for b in __all_dense__}
+_sparse_by_name = {b.__name__[:-len("Block")]: b for b in __all_sparse__}
 
 
 def from_name(name: str, dense_data: bool):
-    for b in __all_dense__ if dense_data else __all_sparse__:
-        if b.__name__ == name + "Block":
-            return b
-    raise ValueError(f"Unknown pooling type {name} for dense_data={dense_data}!")#
+    try:
+        return (_dense_by_name if dense_data else _sparse_by_name)[name]
+    except KeyError:
+        raise ValueError(f"Unknown pooling type {name} for dense_data={dense_data}!") from None
 
 
 def valid_names() -> List[str]:
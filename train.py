@@ -60,19 +60,21 @@ def train_test_epoch(train: bool, model: CustomNet, optimizer,
                      mode: str):
     if train:
         model.train()
-        sum_loss = 0
-        sum_classification_loss = 0
-        sum_pooling_loss = 0
-        sum_sample_probs = 0
-    correct = 0
+        # All statistics are accumulated on device and moved to the host once after the loop: a float()/item()
+        # per batch would force a GPU sync every step and serialize the training loop.
+        sum_loss = torch.zeros((), device=custom_logger.device)
+        sum_classification_loss = torch.zeros((), device=custom_logger.device)
+        sum_pooling_loss = torch.zeros((), device=custom_logger.device)
+        sum_sample_probs = torch.zeros((), device=custom_logger.device)
+    correct = torch.zeros((), dtype=torch.long, device=custom_logger.device)
     num_classes = model.output_layer.num_classes
     if True:  # mode == "val":
-        class_counts = torch.zeros(num_classes)
+        class_counts = torch.zeros(num_classes, device=custom_logger.device)
     if epoch == 0:
-        class_counts_true = torch.zeros(num_classes)
+        class_counts_true = torch.zeros(num_classes, device=custom_logger.device)
     with suppress() if train else torch.no_grad():  # nullcontext() would be better here but is not supported on HPC
         for step, data in enumerate(loader):
-            data = data.to(custom_logger.device)
+            data = data.to(custom_logger.device, non_blocking=True)
             batch_size = data.y.size(0)
             if train:
                 optimizer.zero_grad()
@@ -98,21 +100,23 @@ def train_test_epoch(train: bool, model: CustomNet, optimizer,
                     elif probability_weights_type != "prob":
                         raise ValueError(f"Unknown probability weights type {probability_weights_type}!")
                     classification_loss_per_sample = probabilities * F.nll_loss(out, target, reduction='none')
-                    sum_sample_probs += torch.sum(probabilities).item()
+                    sum_sample_probs += torch.sum(probabilities)
 
                     classification_loss = torch.mean(classification_loss_per_sample)
                 loss = classification_loss + pooling_loss_weight * pooling_loss + model.custom_losses(batch_size)
 
-                sum_loss += batch_size * float(loss)
-                sum_classification_loss += batch_size * float(classification_loss)
-                sum_pooling_loss += batch_size * float(pooling_loss)
+                sum_loss += batch_size * loss.detach()
+                sum_classification_loss += batch_size * classification_loss.detach()
+                # the pooling loss can be a plain 0 for blocks without one
+                sum_pooling_loss += batch_size * (pooling_loss.detach() if torch.is_tensor(pooling_loss)
+                                                  else pooling_loss)
 
             pred_classes = out.argmax(dim=1)
-            correct += int((pred_classes == target).sum())
+            correct += (pred_classes == target).sum()
             if True: #mode == "val":
-                class_counts += torch.bincount(pred_classes.detach(), minlength=num_classes).cpu()
+                class_counts += torch.bincount(pred_classes.detach(), minlength=num_classes)
             if epoch == 0:
-                class_counts_true += torch.bincount(target, minlength=num_classes).cpu()
+                class_counts_true += torch.bincount(target, minlength=num_classes)
 
             if train:
                 # if epoch == 0 and step == 0:
@@ -121,6 +125,16 @@ def train_test_epoch(train: bool, model: CustomNet, optimizer,
                 # if step == 0 and epoch in [0, 1]:
                 #     plot_grad_flow(model.named_parameters(), f"img/gradientflow_{epoch}.pdf")
                 optimizer.step()
+    # one host sync for the whole epoch
+    correct = int(correct)
+    if train:
+        sum_loss = float(sum_loss)
+        sum_classification_loss = float(sum_classification_loss)
+        sum_pooling_loss = float(sum_pooling_loss)
+        sum_sample_probs = float(sum_sample_probs)
+    class_counts = class_counts.cpu()
+    if epoch == 0:
+        class_counts_true = class_counts_true.cpu()
     dataset_len = len(loader.dataset) * num_samples
     model.log_custom_losses(mode, epoch, dataset_len)
     additional_dict = {}
@@ -144,6 +158,8 @@ def train_test_epoch(train: bool, model: CustomNet, optimizer,
 
 def log_formulas(model: CustomNet, train_loader: DataLoader, test_loader: DataLoader, class_names: typing.List[str],
                 epoch: int):
+    if not custom_logger.use_wandb:
+        return
     model.explain(train_loader, test_loader, class_names)
 
 def process_embeddings(embs, epoch, run):
@@ -162,6 +178,9 @@ def process_embeddings(embs, epoch, run):
         log({f"embeddings_{pool_step}": fig}, _run=run, step=epoch)
 
 def log_embeddings(model: CustomNet, data_loader: DataLoader, dense_data: bool, epoch: int, save_path):
+    if not custom_logger.use_wandb:
+        # skip the full inference pass and TSNE, log() would drop the figures anyway
+        return
     # table too big to load (wandb only shows 10000 entries)
     # table = wandb.Table(columns=["pool_step", "x", "y", "point_color", "label"])
     with torch.no_grad():
@@ -302,6 +321,9 @@ def main(args, **kwargs):
     device = torch.device(args.device)
     custom_logger.device = device
     custom_logger.cpu_workers = args.cpu_workers
+    if device.type == "cuda":
+        # batch shapes are consistent (dense data is padded to max_nodes), so autotuned kernel choices are reused
+        torch.backends.cudnn.benchmark = True
     default_num_threads = torch.get_num_threads()
     if getattr(args, "num_threads", 0) > 0:
         torch.set_num_threads(args.num_threads)
@@ -319,16 +341,23 @@ def main(args, **kwargs):
     test_data = dataset[num_train_samples + num_val_samples:]
     torch.manual_seed(args.seed)
 
+    # Pinned host memory allows the (non_blocking) host-to-device copy in train_test_epoch to overlap with
+    # compute. Worker processes (reusing the cpu_workers flag) keep batch collation off the main process.
+    loader_kwargs = dict(batch_size=args.batch_size, pin_memory=device.type == "cuda",
+                         num_workers=args.cpu_workers, persistent_workers=args.cpu_workers > 0)
+    if args.cpu_workers > 0:
+        # queue a few batches per worker so collation stays ahead of the training step
+        loader_kwargs["prefetch_factor"] = 4
     if args.dense_data:
-        train_loader = DenseDataLoader(train_data, batch_size=args.batch_size, shuffle=True)
-        test_loader = DenseDataLoader(test_data, batch_size=args.batch_size, shuffle=True)
-        val_loader = DenseDataLoader(val_data, batch_size=args.batch_size, shuffle=True)
+        train_loader = DenseDataLoader(train_data, shuffle=True, **loader_kwargs)
+        test_loader = DenseDataLoader(test_data, shuffle=True, **loader_kwargs)
+        val_loader = DenseDataLoader(val_data, shuffle=True, **loader_kwargs)
         log_graph_loader = DenseDataLoader(test_data[:args.batch_size], batch_size=args.batch_size, shuffle=False)
 
     else:
-        train_loader = DataLoader(train_data, batch_size=args.batch_size, shuffle=True)
-        test_loader = DataLoader(test_data, batch_size=args.batch_size, shuffle=True)
-        val_loader = DataLoader(val_data, batch_size=args.batch_size, shuffle=True)
+        train_loader = DataLoader(train_data, shuffle=True, **loader_kwargs)
+        test_loader = DataLoader(test_data, shuffle=True, **loader_kwargs)
+        val_loader = DataLoader(val_data, shuffle=True, **loader_kwargs)
         log_graph_loader = DataLoader(test_data[:args.batch_size], batch_size=args.batch_size, shuffle=False)
 
     # Get last (and only data batch from log_graph_loader)
@@ -366,6 +395,10 @@ def main(args, **kwargs):
                   "Resuming training will not be equivalent to letting it run.")
             model.load_state_dict(state_dict)  # Backward compatibility
     model.to(device)
+    if args.compile_model:
+        # fullgraph=False: the clustering and component steps of the pool blocks inevitably break the graph,
+        # inductor still fuses the launch-bound elementwise/reduction chains around them
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
 
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
     if optimizer_params is not None:
@@ -518,10 +551,15 @@ if __name__ == "__main__":
     parser.add_argument('--seed', type=int, default=1,
                         help='The seed used for pytorch.')
     parser.add_argument('--cpu_workers', type=int, default=0,
-                        help='How many workers to spawn for cpu parallelization (like for clustering). '
-                             'If 0, everything will happen in the main process.')
+                        help='How many workers to spawn for cpu parallelization. Note that Monte Carlo sampling no '
+                             'longer uses worker processes (the samples are batched on device instead), so this only '
+                             'affects remaining cpu-side parallelism.')
     parser.add_argument('--num_threads', type=int, default=0,
                         help='Overwrites pytorch\'s num threads if > 0.')
+    parser.add_argument('--compile_model', action='store_true',
+                        help='Wraps the model in torch.compile(mode="reduce-overhead"). Mostly pays off for '
+                             'small-graph batches where kernel launch overhead dominates; the first epochs are '
+                             'slower due to compilation.')
     parser.add_argument('--save_path', type=str,
                         default=os.path.join("models", datetime.now().strftime("%d-%m-%Y_%H-%M-%S-%f")),
                         help='The path to save the checkpoint to. Will be models/dd-mm-YY_HH-MM-SS.pt by default.')